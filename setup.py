@@ -28,12 +28,16 @@ setup(
         'setuptools',
         'Flask',
     ],
+    extras_require={
+        'brotli': ['brotli'],
+    },
     entry_points="""
     [console_scripts]
     flask-ctl = presence_analyzer.script:run
 
     [paste.app_factory]
     main = presence_analyzer.script:make_app
+    nonblocking = presence_analyzer.script:make_nonblocking_app
     debug = presence_analyzer.script:make_debug
     """,
 )
@@ -0,0 +1,574 @@
+# -*- coding: utf-8 -*-
+"""
+Batched aggregation of presence data kept in PresenceStore.
+"""
+
+from array import array
+from bisect import bisect_left
+from datetime import date
+from itertools import izip
+
+
+def weekday(day):
+    """
+    Returns weekday (Monday is 0) of date ordinal.
+    """
+    return (day + 6) % 7
+
+
+def divide(total, count):
+    """
+    Divides like utils.mean() does, returns zero when count is zero.
+    """
+    return float(total) / count if count else 0
+
+
+class WeekdayStats(object):
+    """
+    Per weekday count of days, total interval, sum of starts and ends.
+    """
+    __slots__ = ('counts', 'intervals', 'starts', 'ends')
+
+    def __init__(self):
+        self.counts = [0] * 7
+        self.intervals = [0] * 7
+        self.starts = [0] * 7
+        self.ends = [0] * 7
+
+    def __eq__(self, other):
+        return all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def add(self, day, start, end, sign=1):
+        """
+        Adds one presence row, or removes it when sign is -1.
+        """
+        index = weekday(day)
+        self.counts[index] += sign
+        self.intervals[index] += sign * (end - start)
+        self.starts[index] += sign * start
+        self.ends[index] += sign * end
+
+    def copy(self):
+        """
+        Returns independent copy of self.
+        """
+        stats = WeekdayStats()
+        stats.update(self)
+        return stats
+
+    def update(self, other):
+        """
+        Adds all rows counted by other WeekdayStats.
+        """
+        for name in self.__slots__:
+            mine = getattr(self, name)
+            for index, value in enumerate(getattr(other, name)):
+                mine[index] += value
+
+    def total_intervals(self):
+        """
+        Returns total presence time for every weekday.
+        """
+        return list(self.intervals)
+
+    def mean_intervals(self):
+        """
+        Returns mean presence time for every weekday.
+        """
+        return [divide(*pair) for pair in zip(self.intervals, self.counts)]
+
+    def mean_starts(self):
+        """
+        Returns mean start of presence for every weekday.
+        """
+        return [divide(*pair) for pair in zip(self.starts, self.counts)]
+
+    def mean_ends(self):
+        """
+        Returns mean end of presence for every weekday.
+        """
+        return [divide(*pair) for pair in zip(self.ends, self.counts)]
+
+
+def weekday_stats(store, low, high):
+    """
+    Aggregates rows from low to high of PresenceStore in one pass.
+    """
+    counts = [0] * 7
+    intervals = [0] * 7
+    starts = [0] * 7
+    ends = [0] * 7
+    for day, start, end in izip(
+            store.days[low:high],
+            store.starts[low:high],
+            store.ends[low:high],
+    ):
+        index = (day + 6) % 7  # inlined weekday(day)
+        counts[index] += 1
+        intervals[index] += end - start
+        starts[index] += start
+        ends[index] += end
+
+    stats = WeekdayStats()
+    stats.counts = counts
+    stats.intervals = intervals
+    stats.starts = starts
+    stats.ends = ends
+    return stats
+
+
+def all_weekday_stats(store):
+    """
+    Aggregates rows of all users in one pass over the store.
+
+    Returns dict mapping user id to WeekdayStats.
+    """
+    return dict(
+        (user_id, weekday_stats(store, low, high))
+        for user_id, (low, high) in store.offsets.iteritems()
+    )
+
+
+def update_all_weekday_stats(index, store, added, removed):
+    """
+    Returns all_weekday_stats() index updated with changed rows.
+
+    Given index is left unchanged, WeekdayStats of affected users are
+    copied before update.
+    """
+    # pylint: disable=unused-argument
+    index = dict(index)
+    copied = set()
+    for sign, rows in ((-1, removed), (1, added)):
+        for user_id, day, start, end in rows:
+            if user_id not in copied:
+                stats = index.get(user_id)
+                index[user_id] = stats.copy() if stats else WeekdayStats()
+                copied.add(user_id)
+            index[user_id].add(day, start, end, sign)
+    return index
+
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def occupancy(intervals, slot):
+    """
+    Counts intervals overlapping every `slot` seconds long slot of a day.
+
+    Intervals are (day, start, end) tuples with start and end in seconds
+    since midnight. Returns dict mapping day to list of counts. Every
+    interval only marks where it starts and ends in difference array of
+    its day, which is summed afterwards, so it takes O(intervals + days *
+    slots) instead of O(intervals * slots).
+    """
+    slots = -(-SECONDS_PER_DAY // slot)
+    changes = {}
+    for day, start, end in intervals:
+        if end <= start:
+            continue
+        diff = changes.get(day)
+        if diff is None:
+            diff = changes[day] = [0] * (slots + 1)
+        diff[start // slot] += 1
+        diff[min(-(-end // slot), slots)] -= 1
+
+    result = {}
+    for day, diff in changes.iteritems():
+        counts = result[day] = [0] * slots
+        present = 0
+        for index in xrange(slots):
+            present += diff[index]
+            counts[index] = present
+    return result
+
+
+def weekday_occupancy(occupancy_by_day):
+    """
+    Returns mean counts of occupancy() for every weekday.
+
+    Counts are averaged over days of the weekday which have any interval,
+    weekdays without them are left out.
+    """
+    totals = {}
+    days = {}
+    for day, counts in occupancy_by_day.iteritems():
+        index = weekday(day)
+        total = totals.get(index)
+        if total is None:
+            totals[index] = list(counts)
+        else:
+            for slot, count in enumerate(counts):
+                total[slot] += count
+        days[index] = days.get(index, 0) + 1
+    return dict(
+        (index, [divide(count, days[index]) for count in total])
+        for index, total in totals.iteritems()
+    )
+
+
+def week_key(day):
+    """
+    Returns 'YYYY-Www' ISO week of date ordinal.
+    """
+    year, week, _ = date.fromordinal(day).isocalendar()
+    return '{0:04d}-W{1:02d}'.format(year, week)
+
+
+def month_key(day):
+    """
+    Returns 'YYYY-MM' month of date ordinal.
+    """
+    day = date.fromordinal(day)
+    return '{0:04d}-{1:02d}'.format(day.year, day.month)
+
+
+# names of rollup periods and functions giving period of date ordinal
+PERIODS = {
+    'week': week_key,
+    'month': month_key,
+}
+
+
+class Rollups(object):
+    """
+    Number of days and total presence time per period, like ISO week.
+
+    `users` maps period name to {user_id: {period: [days, seconds]}} and
+    `organisation` maps it to {period: [days, seconds]} of all users.
+    Rollups are updated in place only while they are built, update() of
+    shared rollups returns updated copy.
+    """
+    __slots__ = ('users', 'organisation', 'keys')
+
+    def __init__(self):
+        self.users = dict((name, {}) for name in PERIODS)
+        self.organisation = dict((name, {}) for name in PERIODS)
+        # date ordinal -> period keys, there are few distinct days
+        self.keys = {}
+
+    def __eq__(self, other):
+        return (
+            self.users == other.users and
+            self.organisation == other.organisation
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def period_keys(self, day):
+        """
+        Returns list of (period name, period) pairs of date ordinal.
+        """
+        keys = self.keys.get(day)
+        if keys is None:
+            keys = self.keys[day] = [
+                (name, key_function(day))
+                for name, key_function in PERIODS.iteritems()
+            ]
+        return keys
+
+    def add(self, user_id, day, start, end, sign=1):
+        """
+        Adds one presence row, or removes it when sign is -1.
+        """
+        seconds = sign * (end - start)
+        for name, key in self.period_keys(day):
+            buckets = self.users[name].get(user_id)
+            if buckets is None:
+                buckets = self.users[name][user_id] = {}
+            for bucket_dict in (buckets, self.organisation[name]):
+                bucket = bucket_dict.get(key)
+                if bucket is None:
+                    bucket = bucket_dict[key] = [0, 0]
+                bucket[0] += sign
+                bucket[1] += seconds
+                if not bucket[0]:
+                    del bucket_dict[key]
+
+    def update(self, added, removed):
+        """
+        Returns copy of self with rows added and removed.
+
+        Only buckets of affected users and periods are copied, the rest
+        is shared with self.
+        """
+        rollups = Rollups()
+        rollups.keys = self.keys
+        copied = set()
+        for name in PERIODS:
+            rollups.users[name] = dict(self.users[name])
+            rollups.organisation[name] = dict(
+                (key, list(bucket))
+                for key, bucket in self.organisation[name].iteritems()
+            )
+        for sign, rows in ((-1, removed), (1, added)):
+            for user_id, day, start, end in rows:
+                if user_id not in copied:
+                    for name in PERIODS:
+                        buckets = rollups.users[name].get(user_id, {})
+                        rollups.users[name][user_id] = dict(
+                            (key, list(bucket))
+                            for key, bucket in buckets.iteritems()
+                        )
+                    copied.add(user_id)
+                rollups.add(user_id, day, start, end, sign)
+        return rollups
+
+    def report(self, name, user_id=None):
+        """
+        Returns sorted (period, total, mean) tuples of user or organisation.
+
+        Mean is presence time per day of presence. Returns None when there
+        is no such user.
+        """
+        if user_id is None:
+            buckets = self.organisation[name]
+        else:
+            buckets = self.users[name].get(user_id)
+            if buckets is None:
+                return None
+        return [
+            (key, seconds, divide(seconds, days))
+            for key, (days, seconds) in sorted(buckets.iteritems())
+        ]
+
+
+def all_rollups(store):
+    """
+    Builds Rollups of all rows of store.
+
+    Buckets of users are filled first and summed into buckets of the
+    organisation afterwards, which is faster than Rollups.add().
+    """
+    rollups = Rollups()
+    names = list(PERIODS)
+    period_keys = {}
+    for user_id in store.users():
+        user_buckets = [{} for _ in names]
+        for day, start, end in store.user(user_id).rows():
+            keys = period_keys.get(day)
+            if keys is None:
+                keys = period_keys[day] = [
+                    PERIODS[name](day) for name in names
+                ]
+            seconds = end - start
+            for buckets, key in izip(user_buckets, keys):
+                bucket = buckets.get(key)
+                if bucket is None:
+                    buckets[key] = [1, seconds]
+                else:
+                    bucket[0] += 1
+                    bucket[1] += seconds
+
+        for name, buckets in izip(names, user_buckets):
+            rollups.users[name][user_id] = buckets
+            organisation = rollups.organisation[name]
+            for key, (days, seconds) in buckets.iteritems():
+                bucket = organisation.get(key)
+                if bucket is None:
+                    organisation[key] = [days, seconds]
+                else:
+                    bucket[0] += days
+                    bucket[1] += seconds
+    return rollups
+
+
+def update_all_rollups(index, store, added, removed):
+    """
+    Returns all_rollups() index updated with changed rows.
+    """
+    # pylint: disable=unused-argument
+    return index.update(added, removed)
+
+
+# width of histogram bins in seconds, starts and ends are within a day
+HISTOGRAM_BIN = 60
+
+# names of percentiles served besides means
+PERCENTILES = {
+    'p10': 10,
+    'median': 50,
+    'p90': 90,
+}
+
+
+class Histogram(object):
+    """
+    Immutable histogram of values in HISTOGRAM_BIN seconds long bins.
+
+    Only bins with values are kept, as sorted array of bin numbers and
+    array of cumulative counts, so percentiles are found with binary
+    search and never by sorting values.
+    """
+    __slots__ = ('bins', 'cumulative')
+
+    def __init__(self, counts=None):
+        """
+        Builds histogram from dict mapping bin numbers to counts.
+        """
+        self.bins = array('H')
+        self.cumulative = array('i')
+        total = 0
+        for key in sorted(counts or ()):
+            if counts[key]:
+                total += counts[key]
+                self.bins.append(key)
+                self.cumulative.append(total)
+
+    def __eq__(self, other):
+        return (
+            self.bins == other.bins and self.cumulative == other.cumulative
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __len__(self):
+        return self.cumulative[-1] if self.cumulative else 0
+
+    def counts(self):
+        """
+        Returns dict mapping bin numbers to counts.
+        """
+        previous = 0
+        counts = {}
+        for key, total in izip(self.bins, self.cumulative):
+            counts[key] = total - previous
+            previous = total
+        return counts
+
+    def changed(self, changes):
+        """
+        Returns new histogram with counts changed by given bin -> delta.
+        """
+        counts = self.counts()
+        for key, delta in changes.iteritems():
+            counts[key] = counts.get(key, 0) + delta
+        return Histogram(counts)
+
+    def percentile(self, percent):
+        """
+        Returns lower bound of bin holding given percentile, 0 if empty.
+        """
+        total = len(self)
+        if not total:
+            return 0
+        rank = max(1, -(-total * percent // 100))
+        return self.bins[bisect_left(self.cumulative, rank)] * HISTOGRAM_BIN
+
+
+def histogram_bins(start, end):
+    """
+    Returns bin numbers of start, end and interval of one presence row.
+    """
+    return (
+        start // HISTOGRAM_BIN,
+        end // HISTOGRAM_BIN,
+        max(end - start, 0) // HISTOGRAM_BIN,
+    )
+
+
+class HistogramStats(object):
+    """
+    Per weekday histograms of starts, ends and intervals of presence.
+
+    Every attribute is a list of seven Histograms.
+    """
+    __slots__ = ('starts', 'ends', 'intervals')
+
+    def __init__(self, starts=None, ends=None, intervals=None):
+        self.starts = starts or [Histogram() for _ in range(7)]
+        self.ends = ends or [Histogram() for _ in range(7)]
+        self.intervals = intervals or [Histogram() for _ in range(7)]
+
+    def __eq__(self, other):
+        return all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def changed(self, rows, sign=1):
+        """
+        Returns new HistogramStats with (day, start, end) rows added.
+
+        Rows are removed when sign is -1. Only histograms of affected
+        weekdays are rebuilt, the rest is shared with self.
+        """
+        changes = {}
+        for day, start, end in rows:
+            index = weekday(day)
+            for name, key in izip(self.__slots__, histogram_bins(start, end)):
+                histogram = changes.setdefault((name, index), {})
+                histogram[key] = histogram.get(key, 0) + sign
+
+        attributes = dict(
+            (name, list(getattr(self, name))) for name in self.__slots__
+        )
+        for (name, index), histogram in changes.iteritems():
+            attributes[name][index] = (
+                attributes[name][index].changed(histogram)
+            )
+        return HistogramStats(**attributes)
+
+    def percentiles(self, name, percent):
+        """
+        Returns percentile of starts, ends or intervals for every weekday.
+        """
+        return [
+            histogram.percentile(percent) for histogram in getattr(self, name)
+        ]
+
+
+def histogram_stats(rows):
+    """
+    Builds HistogramStats of (day, start, end) rows.
+
+    Values are counted per bin, so they are never sorted.
+    """
+    counts = [[{} for _ in range(7)] for _ in HistogramStats.__slots__]
+    starts, ends, intervals = counts
+    for day, start, end in rows:
+        index = (day + 6) % 7  # inlined weekday(day)
+        bins = starts[index]
+        key = start // HISTOGRAM_BIN
+        bins[key] = bins.get(key, 0) + 1
+        bins = ends[index]
+        key = end // HISTOGRAM_BIN
+        bins[key] = bins.get(key, 0) + 1
+        bins = intervals[index]
+        key = (end - start) // HISTOGRAM_BIN if end > start else 0
+        bins[key] = bins.get(key, 0) + 1
+    return HistogramStats(*[
+        [Histogram(weekday_counts) for weekday_counts in lists]
+        for lists in counts
+    ])
+
+
+def update_histograms(index, store, added, removed):
+    """
+    Returns dict of user id -> HistogramStats updated with changed rows.
+
+    Index holds only users whose histograms were asked for, so only they
+    are updated. Given index is left unchanged, HistogramStats of
+    affected users are replaced with changed copies.
+    """
+    # pylint: disable=unused-argument
+    index = dict(index)
+    for sign, rows in ((-1, removed), (1, added)):
+        by_user = {}
+        for user_id, day, start, end in rows:
+            if user_id in index:
+                by_user.setdefault(user_id, []).append((day, start, end))
+        for user_id, user_rows in by_user.iteritems():
+            index[user_id] = index[user_id].changed(user_rows, sign)
+    return index
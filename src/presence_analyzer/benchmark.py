@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of presence data loading.
+
+Usage: python -m presence_analyzer.benchmark [ROWS [SOURCE_CSV]]
+       python -m presence_analyzer.benchmark load URL [THREADS [REQUESTS]]
+       python -m presence_analyzer.benchmark suite [USERS [DAYS [MALFORMED
+                                                     [RESULTS_JSON]]]]
+       python -m presence_analyzer.benchmark compare OLD_JSON NEW_JSON
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import urllib2
+import resource
+import tempfile
+import threading
+import traceback
+from datetime import date, timedelta
+
+from presence_analyzer.main import app
+from presence_analyzer.utils import (
+    data_cache,
+    file_signature,
+    get_data,
+    group_by_weekday,
+    group_start_end_weekday,
+    load_csv,
+    load_store,
+    mean,
+    response_cache,
+    start_parse_pool,
+    stop_parse_pool,
+)
+
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data',
+    'sample_data.csv'
+)
+
+
+def scale_csv(source, target, rows):
+    """
+    Writes `rows` lines to target by repeating source file.
+
+    Every repetition gets its own range of user ids, so the result has
+    as many distinct (user_id, date) pairs as it has lines.
+    """
+    with open(source, 'r') as csvfile:
+        lines = [line.rstrip('\r\n').split(',', 1) for line in csvfile]
+    lines = [(int(user_id), rest) for user_id, rest in lines]
+    step = max(user_id for user_id, _ in lines) + 1
+
+    written = 0
+    with open(target, 'w') as csvfile:
+        copy = 0
+        while written < rows:
+            offset = copy * step
+            chunk = lines[:rows - written]
+            csvfile.writelines(
+                '{0},{1}\n'.format(user_id + offset, rest)
+                for user_id, rest in chunk
+            )
+            written += len(chunk)
+            copy += 1
+    return written
+
+
+def timed(function, *args):
+    """
+    Returns tuple of function result and seconds it took.
+    """
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def bench_parsers(path):
+    """
+    Compares load_store() with strptime and with the fast row parser.
+    """
+    results = {}
+    fast_parser = app.config['DATA_FAST_PARSER']
+    try:
+        for name, fast in (('strptime', False), ('fast', True)):
+            app.config['DATA_FAST_PARSER'] = fast
+            store, seconds = timed(load_store, path)
+            results[name] = seconds
+            print('{0:>10}: {1:8.3f} s, {2:10.0f} rows/s'.format(
+                name, seconds, len(store) / seconds
+            ))
+            del store
+    finally:
+        app.config['DATA_FAST_PARSER'] = fast_parser
+    print('{0:>10}: {1:8.2f} x'.format(
+        'speedup', results['strptime'] / results['fast']
+    ))
+    return results
+
+
+def bench_readers(path):
+    """
+    Compares csv module and chunked reader of CSV file.
+    """
+    results = {}
+    chunked = app.config['DATA_CHUNKED_READER']
+    try:
+        for name, enabled in (('csv', False), ('chunked', True)):
+            app.config['DATA_CHUNKED_READER'] = enabled
+            store, seconds = timed(load_store, path)
+            results[name] = seconds
+            print('{0:>10}: {1:8.3f} s, {2:10.0f} rows/s'.format(
+                name, seconds, len(store) / seconds
+            ))
+            del store
+    finally:
+        app.config['DATA_CHUNKED_READER'] = chunked
+    return results
+
+
+def bench_parallel(path, workers=(1, 2, 4)):
+    """
+    Compares parsing of CSV file with different numbers of processes.
+    """
+    results = {}
+    config = dict(
+        (key, app.config[key])
+        for key in ('DATA_PARSE_WORKERS', 'DATA_PARALLEL_MIN_SIZE')
+    )
+    app.config['DATA_PARALLEL_MIN_SIZE'] = 0
+    try:
+        for count in workers:
+            app.config['DATA_PARSE_WORKERS'] = count
+            start_parse_pool()
+            try:
+                store, seconds = timed(load_store, path)
+            finally:
+                stop_parse_pool()
+            results[count] = seconds
+            print('{0:>8} p: {1:8.3f} s, {2:10.0f} rows/s'.format(
+                count, seconds, len(store) / seconds
+            ))
+            del store
+    finally:
+        app.config.update(config)
+    return results
+
+
+def bench_snapshot(path):
+    """
+    Compares parsing of CSV file with mapping its binary snapshot.
+    """
+    snapshot = app.config['DATA_SNAPSHOT']
+    app.config['DATA_SNAPSHOT'] = path + '.snapshot'
+    try:
+        signature = file_signature(path)
+        _, parsing = timed(load_csv, path, signature)
+        _, mapping = timed(load_csv, path, signature)
+    finally:
+        app.config['DATA_SNAPSHOT'] = snapshot
+    print('{0:>10}: {1:8.3f} s'.format('parse', parsing))
+    print('{0:>10}: {1:8.3f} s'.format('snapshot', mapping))
+    return {'parse': parsing, 'snapshot': mapping}
+
+
+def percentile(values, percent):
+    """
+    Returns value below which given percent of sorted values fall.
+    """
+    if not values:
+        return 0
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def load_test(url, threads=50, requests=1000):
+    """
+    Sends requests to running server from many threads at once.
+
+    Prints throughput and latency percentiles, which makes it possible to
+    compare server setups, e.g. paster serve with `main` and `nonblocking`
+    application while DATA_CSV is being appended to.
+    """
+    latencies = []
+    errors = []
+    counter = iter(xrange(requests))
+    lock = threading.Lock()
+
+    def worker():
+        """
+        Sends requests until there are none left.
+        """
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            start = time.time()
+            try:
+                urllib2.urlopen(url).read()
+            except (urllib2.URLError, IOError) as error:
+                errors.append(error)
+                continue
+            latencies.append(time.time() - start)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    seconds = time.time() - start
+
+    latencies.sort()
+    results = {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'requests_per_second': len(latencies) / seconds,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+    }
+    print('{requests} requests, {errors} errors, '
+          '{requests_per_second:.1f} req/s'.format(**results))
+    print('p50 {p50:.4f} s, p90 {p90:.4f} s, p99 {p99:.4f} s'.format(
+        **results
+    ))
+    return results
+
+
+def generate_csv(path, users, days, malformed=0.0, seed=0):
+    """
+    Writes synthetic presence of `users` users over `days` working days.
+
+    Given fraction of lines is malformed in one of the ways found in real
+    exports. Returns number of lines written.
+    """
+    rand = random.Random(seed)
+    first_day = date(2013, 1, 1)
+    dates = []
+    day = first_day
+    while len(dates) < days:
+        if day.weekday() < 5:
+            dates.append(day.isoformat())
+        day += timedelta(days=1)
+    broken = (
+        lambda user_id, day: 'user_id,date,start,end',
+        lambda user_id, day: '{0},{1},25:00:00,16:00:00'.format(user_id, day),
+        lambda user_id, day: '{0},{1}-31,08:00:00'.format(user_id, day[:7]),
+        lambda user_id, day: 'x{0},{1},08:00:00,16:00:00'.format(user_id, day),
+    )
+
+    lines = 0
+    with open(path, 'w') as csvfile:
+        for user_id in xrange(1, users + 1):
+            for day in dates:
+                if malformed and rand.random() < malformed:
+                    line = rand.choice(broken)(user_id, day)
+                else:
+                    start = rand.randint(6 * 3600, 11 * 3600)
+                    end = start + rand.randint(3600, 10 * 3600)
+                    line = '{0},{1},{2:02d}:{3:02d}:{4:02d},'\
+                        '{5:02d}:{6:02d}:{7:02d}'.format(
+                            user_id, day,
+                            start // 3600, start // 60 % 60, start % 60,
+                            end // 3600, end // 60 % 60, end % 60,
+                        )
+                csvfile.write(line + '\n')
+                lines += 1
+    return lines
+
+
+def peak_memory():
+    """
+    Returns peak resident memory of this process in megabytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on OS X
+    return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+
+def measure(function, items, repeat=1):
+    """
+    Calls function for every item `repeat` times, collects statistics.
+
+    Returns dict with number of calls, calls per second, latency
+    percentiles in seconds and growth of peak memory in megabytes.
+
+    Peak memory of a process never goes down, so calls are made in a
+    forked process, whose peak starts at its memory at fork and grows
+    only with what the calls use. Nothing the calls change is seen by
+    the caller.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            start_memory = peak_memory()
+            result = measure_calls(function, items, repeat)
+            result['peak_memory_delta_mb'] = peak_memory() - start_memory
+            with os.fdopen(write_fd, 'w') as result_file:
+                json.dump(result, result_file)
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+        finally:
+            os._exit(0)  # pylint: disable=protected-access
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as result_file:
+        output = result_file.read()
+    os.waitpid(pid, 0)
+    if not output:
+        raise AssertionError('Benchmark process failed')
+    return json.loads(output)
+
+
+def measure_calls(function, items, repeat):
+    """
+    Calls function for every item `repeat` times, returns statistics.
+    """
+    latencies = []
+    for _ in xrange(repeat):
+        for item in items:
+            start = time.time()
+            function(item)
+            latencies.append(time.time() - start)
+    total = sum(latencies)
+    latencies.sort()
+    return {
+        'calls': len(latencies),
+        'calls_per_second': len(latencies) / total if total else 0,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1] if latencies else 0,
+    }
+
+
+def bench_suite(path, repeat=3, user_sample=100):
+    """
+    Measures loading, aggregation helpers and API views on given file.
+
+    Caches are cleared before each call of get_data() and each request,
+    so every call does the full amount of work.
+    """
+    results = {}
+
+    def load(_):
+        """
+        Loads and converts presence data from scratch.
+        """
+        data_cache.clear()
+        return get_data()
+
+    results['get_data'] = measure(load, [None], repeat)
+    data = get_data()
+    users = sorted(data)[:user_sample]
+
+    results['group_by_weekday'] = measure(
+        lambda user_id: group_by_weekday(data[user_id]), users, repeat
+    )
+    results['group_start_end_weekday'] = measure(
+        lambda user_id: group_start_end_weekday(data[user_id]), users, repeat
+    )
+    grouped = [group_by_weekday(data[user_id]) for user_id in users]
+    results['mean'] = measure(
+        lambda weekdays: [mean(intervals) for intervals in weekdays],
+        grouped, repeat
+    )
+
+    client = app.test_client()
+
+    def request(url):
+        """
+        Requests url with empty response cache.
+        """
+        response_cache.clear()
+        response = client.get(url)
+        if response.status_code != 200:
+            raise AssertionError('{0}: {1}'.format(url, response.status))
+        return response.data
+
+    ids = ','.join(str(user_id) for user_id in users)
+    results['view users'] = measure(request, ['/api/v1/users'], repeat)
+    for name in ('mean_time_weekday', 'presence_weekday',
+                 'presence_start_end'):
+        results['view ' + name] = measure(request, [
+            '/api/v1/{0}/{1}'.format(name, user_id) for user_id in users
+        ], repeat)
+        results['view {0} batch'.format(name)] = measure(request, [
+            '/api/v1/{0}?user_id={1}'.format(name, ids)
+        ], repeat)
+
+    for name in sorted(results):
+        print('{0:>32}: {calls_per_second:10.1f} /s, p50 {p50:.5f} s, '
+              'p99 {p99:.5f} s, +{peak_memory_delta_mb:.1f} MB'.format(
+                  name, **results[name]
+              ))
+    return results
+
+
+def run_suite(users=1000, days=250, malformed=0.01, output=None):
+    """
+    Generates synthetic data, benchmarks it and saves results as JSON.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    data_csv = app.config.get('DATA_CSV')
+    try:
+        path = os.path.join(tmp_dir, 'data.csv')
+        lines = generate_csv(path, users, days, malformed)
+        print('{0} lines, {1:.1f} MB'.format(
+            lines, os.path.getsize(path) / 1024.0 / 1024
+        ))
+        app.config['DATA_CSV'] = path
+        results = {
+            'parameters': {
+                'users': users,
+                'days': days,
+                'malformed': malformed,
+                'lines': lines,
+            },
+            'benchmarks': bench_suite(path),
+        }
+    finally:
+        app.config['DATA_CSV'] = data_csv
+        data_cache.clear()
+        response_cache.clear()
+        shutil.rmtree(tmp_dir)
+
+    if output:
+        with open(output, 'w') as results_file:
+            json.dump(results, results_file, indent=2, sort_keys=True)
+    return results
+
+
+def compare(old_path, new_path):
+    """
+    Prints throughput change of benchmarks saved by run_suite().
+    """
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old = json.load(old_file)['benchmarks']
+        new = json.load(new_file)['benchmarks']
+    changes = {}
+    for name in sorted(set(old) & set(new)):
+        before = old[name]['calls_per_second']
+        changes[name] = new[name]['calls_per_second'] / before if before else 0
+        print('{0:>32}: {1:8.2f} x'.format(name, changes[name]))
+    return changes
+
+
+def main(argv=None):
+    """
+    Scales sample data up and runs benchmarks on it.
+    """
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == 'load':
+        load_test(argv[1], *[int(arg) for arg in argv[2:4]])
+        return
+    if argv and argv[0] == 'suite':
+        types = (int, int, float, str)
+        run_suite(*[cast(arg) for cast, arg in zip(types, argv[1:5])])
+        return
+    if argv and argv[0] == 'compare':
+        compare(argv[1], argv[2])
+        return
+    rows = int(argv[0]) if argv else 3000000
+    source = argv[1] if len(argv) > 1 else SAMPLE_DATA_CSV
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'data.csv')
+        scale_csv(source, path, rows)
+        print('{0} rows, {1:.1f} MB'.format(
+            rows, os.path.getsize(path) / 1024.0 / 1024
+        ))
+        bench_parsers(path)
+        bench_readers(path)
+        bench_parallel(path)
+        bench_snapshot(path)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
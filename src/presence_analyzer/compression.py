@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Compression of responses and precompressed static files.
+"""
+
+import os
+import zlib
+import hashlib
+import mimetypes
+import threading
+from collections import namedtuple
+
+from flask import request
+
+from presence_analyzer.main import app
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None  # pylint: disable=invalid-name
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# supported encodings, preferred first
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+# compression levels of API responses, which are compressed once per data
+# version, and of static files, which are compressed once at startup
+API_LEVELS = {'gzip': 6, 'br': 5}
+STATIC_LEVELS = {'gzip': 9, 'br': 11}
+
+COMPRESSIBLE_TYPES = (
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+)
+FINGERPRINT_LENGTH = 12
+
+Asset = namedtuple('Asset', ['mimetype', 'fingerprint', 'bodies', 'immutable'])
+
+
+def compress(data, encoding, level):
+    """
+    Returns data compressed with given encoding.
+    """
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, level=API_LEVELS['gzip']):
+    """
+    Yields gzip stream of given chunks as compressed data is produced.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def accepted_encoding(encodings=ENCODINGS):
+    """
+    Returns best of given encodings accepted by client or None.
+    """
+    return request.accept_encodings.best_match(encodings)
+
+
+def encoded_etag(etag, encoding):
+    """
+    Returns ETag of representation in given encoding.
+    """
+    if encoding is None:
+        return etag
+    return '{0}-{1}'.format(etag, encoding)
+
+
+def make_asset(name, data, immutable=False):
+    """
+    Returns Asset of static file with bodies in all smaller encodings.
+    """
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    bodies = {None: data}
+    if mimetype.startswith('text/') or mimetype in COMPRESSIBLE_TYPES:
+        for encoding in ENCODINGS:
+            body = compress(data, encoding, STATIC_LEVELS[encoding])
+            if len(body) < len(data):
+                bodies[encoding] = body
+    fingerprint = hashlib.md5(data).hexdigest()[:FINGERPRINT_LENGTH]
+    return Asset(mimetype, fingerprint, bodies, immutable)
+
+
+def fingerprinted_name(name, fingerprint):
+    """
+    Returns name of file with fingerprint inserted before its extension.
+    """
+    root, ext = os.path.splitext(name)
+    return '{0}.{1}{2}'.format(root, fingerprint, ext)
+
+
+def load_assets(folder):
+    """
+    Reads and compresses all files in static folder.
+
+    Returns dict mapping names relative to folder to Assets. Every file
+    except HTML pages is also available under fingerprinted name, as an
+    immutable Asset, and pages refer to files by those names.
+    """
+    files = {}
+    for root, _, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(root, name)
+            with open(path, 'rb') as static_file:
+                files[os.path.relpath(path, folder).replace(os.sep, '/')] = (
+                    static_file.read()
+                )
+
+    prefix = app.static_url_path + '/'
+    assets, references = {}, {}
+    for name, data in files.iteritems():
+        if not name.endswith('.html'):
+            asset = assets[name] = make_asset(name, data)
+            fingerprinted = fingerprinted_name(name, asset.fingerprint)
+            assets[fingerprinted] = asset._replace(immutable=True)
+            references['"{0}{1}"'.format(prefix, name)] = (
+                '"{0}{1}"'.format(prefix, fingerprinted)
+            )
+    for name, data in files.iteritems():
+        if name.endswith('.html'):
+            for reference, fingerprinted in references.iteritems():
+                data = data.replace(reference, fingerprinted)
+            assets[name] = make_asset(name, data)
+    return assets
+
+
+loaded_assets = {}  # pylint: disable=invalid-name
+assets_lock = threading.Lock()  # pylint: disable=invalid-name
+
+
+def static_assets():
+    """
+    Returns Assets of static folder, loading them on first use.
+    """
+    with assets_lock:
+        if not loaded_assets:
+            loaded_assets.update(load_assets(app.static_folder))
+        return loaded_assets
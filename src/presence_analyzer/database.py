@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data kept in SQLite database.
+"""
+
+import sqlite3
+import threading
+from array import array
+from collections import namedtuple
+
+from presence_analyzer.aggregation import WeekdayStats
+from presence_analyzer.store import TYPECODE, PresenceStore
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS presence (
+    user_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    start_time INTEGER NOT NULL,
+    end_time INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+);
+CREATE TABLE IF NOT EXISTS source (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    inode INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    position INTEGER NOT NULL,
+    tail BLOB NOT NULL
+);
+"""
+
+Source = namedtuple('Source', ['signature', 'offset', 'tail'])
+
+
+class SQLiteStore(object):
+    """
+    Presence rows in SQLite table with the same interface as PresenceStore.
+
+    Rows are kept as (user_id, day, start, end) integers like in
+    PresenceStore and the primary key on (user_id, day) lets queries of
+    one user read only that user's rows. Every thread gets its own
+    connection, which is closed when the store is garbage collected.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self.connection() as connection:
+            connection.executescript(SCHEMA)
+
+    def connection(self):
+        """
+        Returns connection of current thread.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path)
+        return connection
+
+    def upsert(self, rows):
+        """
+        Inserts rows, replacing existing rows of the same user and day.
+
+        Rows are inserted in one transaction. Returns number of rows.
+        """
+        counter = [0]
+
+        def counted():
+            """
+            Yields rows while counting them.
+            """
+            for row in rows:
+                counter[0] += 1
+                yield row
+
+        with self.connection() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO presence VALUES (?, ?, ?, ?)',
+                counted()
+            )
+        return counter[0]
+
+    def source(self):
+        """
+        Returns Source describing the last imported CSV file or None.
+        """
+        row = self.connection().execute(
+            'SELECT inode, size, mtime, position, tail FROM source'
+        ).fetchone()
+        if row is None:
+            return None
+        return Source(tuple(row[:3]), row[3], str(row[4]))
+
+    def set_source(self, source):
+        """
+        Remembers signature of imported CSV file and where import ended.
+        """
+        with self.connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO source VALUES (0, ?, ?, ?, ?, ?)',
+                tuple(source.signature) + (
+                    source.offset, sqlite3.Binary(source.tail),
+                )
+            )
+
+    def __len__(self):
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM presence'
+        ).fetchone()[0]
+
+    def __contains__(self, user_id):
+        return self.connection().execute(
+            'SELECT 1 FROM presence WHERE user_id = ? LIMIT 1', (user_id,)
+        ).fetchone() is not None
+
+    def users(self):
+        """
+        Returns sorted list of user ids.
+        """
+        return [
+            user_id for user_id, in self.connection().execute(
+                'SELECT DISTINCT user_id FROM presence ORDER BY user_id'
+            )
+        ]
+
+    def weekday_stats(self, user_id, first_day=None, last_day=None):
+        """
+        Aggregates rows of given user between given days in SQL.
+
+        Days are date ordinals, like in PresenceStore.span().
+        """
+        query = (
+            'SELECT (day + 6) % 7, COUNT(*), SUM(end_time - start_time), '
+            'SUM(start_time), SUM(end_time) FROM presence WHERE user_id = ?'
+        )
+        params = [user_id]
+        if first_day is not None:
+            query += ' AND day >= ?'
+            params.append(first_day)
+        if last_day is not None:
+            query += ' AND day <= ?'
+            params.append(last_day)
+        query += ' GROUP BY 1'
+
+        stats = WeekdayStats()
+        for index, count, interval, start, end in self.connection().execute(
+                query, params
+        ):
+            stats.counts[index] = count
+            stats.intervals[index] = interval
+            stats.starts[index] = start
+            stats.ends[index] = end
+        return stats
+
+    def intervals(self, first_day=None, last_day=None):
+        """
+        Yields (day, start, end) of all users between given days inclusive.
+        """
+        query = 'SELECT day, start_time, end_time FROM presence WHERE 1'
+        params = []
+        if first_day is not None:
+            query += ' AND day >= ?'
+            params.append(first_day)
+        if last_day is not None:
+            query += ' AND day <= ?'
+            params.append(last_day)
+        return self.connection().execute(query, params)
+
+    def user(self, user_id, first_day=None, last_day=None):
+        """
+        Returns presence of given user like PresenceStore.user().
+        """
+        return self.to_store(user_id).user(user_id, first_day, last_day)
+
+    def to_store(self, user_id=None):
+        """
+        Returns all rows, or rows of given user, loaded into PresenceStore.
+        """
+        query = 'SELECT user_id, day, start_time, end_time FROM presence'
+        params = ()
+        if user_id is not None:
+            query += ' WHERE user_id = ?'
+            params = (user_id,)
+        columns = [array(TYPECODE) for _ in range(4)]
+        for row in self.connection().execute(
+                query + ' ORDER BY user_id, day', params
+        ):
+            for column, value in zip(columns, row):
+                column.append(value)
+        return PresenceStore(*columns)
+
+    def to_dict(self):
+        """
+        Returns data in the nested dict structure of get_data().
+        """
+        return self.to_store().to_dict()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in timing, counters and profiling of requests.
+"""
+
+import os
+import time
+import logging
+import cProfile
+import tempfile
+import threading
+from json import dumps
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context
+
+from presence_analyzer.main import app
+
+log = logging.getLogger(__name__)  # pylint: disable=invalid-name
+
+METRICS_PREFIX = 'presence_analyzer_'
+
+
+class Metrics(object):
+    """
+    Thread-safe counters and timers rendered in Prometheus text format.
+
+    Timers are kept as count and sum of observed seconds, like Prometheus
+    summaries without quantiles.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        """
+        Adds value to counter.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """
+        Records one timing of given name.
+        """
+        with self._lock:
+            calls, total = self.timers.get(name, (0, 0.0))
+            self.timers[name] = (calls + 1, total + seconds)
+
+    def clear(self):
+        """
+        Resets all counters and timers.
+        """
+        with self._lock:
+            self.counters.clear()
+            self.timers.clear()
+
+    def render(self, gauges=None):
+        """
+        Returns counters, timers and given gauges in Prometheus format.
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            timers = dict(self.timers)
+        lines = []
+        for name, value in sorted(counters.iteritems()):
+            name = METRICS_PREFIX + name + '_total'
+            lines.append('# TYPE {0} counter'.format(name))
+            lines.append('{0} {1}'.format(name, value))
+        for name, (calls, total) in sorted(timers.iteritems()):
+            name = METRICS_PREFIX + name + '_seconds'
+            lines.append('# TYPE {0} summary'.format(name))
+            lines.append('{0}_count {1}'.format(name, calls))
+            lines.append('{0}_sum {1!r}'.format(name, total))
+        for name, value in sorted((gauges or {}).iteritems()):
+            name = METRICS_PREFIX + name
+            lines.append('# TYPE {0} gauge'.format(name))
+            lines.append('{0} {1!r}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()  # pylint: disable=invalid-name
+
+
+def enabled():
+    """
+    Returns True when INSTRUMENTATION option is on.
+    """
+    return app.config['INSTRUMENTATION']
+
+
+def count(name, value=1):
+    """
+    Adds value to counter when instrumentation is enabled.
+    """
+    if enabled():
+        metrics.increment(name, value)
+
+
+@contextmanager
+def timing(name):
+    """
+    Measures time of the with block when instrumentation is enabled.
+
+    Inside a request timing is also added to its Server-Timing header.
+    """
+    if not enabled():
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - start
+        metrics.observe(name, seconds)
+        if has_request_context():
+            g.setdefault('timings', []).append((name, seconds))
+
+
+def profiling_requested():
+    """
+    Returns True when current request should be profiled.
+
+    Every request is profiled with PROFILE_REQUESTS option, in debug mode
+    also requests with `_profile` query parameter.
+    """
+    return app.config['PROFILE_REQUESTS'] or (
+        app.debug and '_profile' in request.args
+    )
+
+
+@app.before_request
+def start_request():
+    """
+    Starts timing and profiling of request.
+    """
+    if enabled():
+        g.started = time.time()
+    if profiling_requested():
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+
+
+@app.after_request
+def finish_request(response):
+    """
+    Adds Server-Timing header and logs request.
+    """
+    if enabled() and 'started' in g:
+        seconds = time.time() - g.started
+        metrics.observe('request', seconds)
+        metrics.increment('requests')
+        timings = g.get('timings', []) + [('total', seconds)]
+        response.headers['Server-Timing'] = ', '.join(
+            '{0};dur={1:.3f}'.format(name, duration * 1000)
+            for name, duration in timings
+        )
+        log.info(dumps({
+            'endpoint': request.endpoint,
+            'path': request.full_path,
+            'status': response.status_code,
+            'timings': dict(timings),
+        }, sort_keys=True))
+    return response
+
+
+@app.teardown_request
+def finish_profile(exception=None):
+    """
+    Stops profiling of request and dumps its profile.
+
+    Teardown runs also when the view raised and after streamed response
+    was sent, so failed requests and streaming are profiled too.
+    """
+    profile = g.get('profile')
+    if profile is None:
+        return
+    profile.disable()
+    g.profile = None
+    path = os.path.join(
+        app.config['PROFILE_DIR'] or tempfile.gettempdir(),
+        '{0}-{1:.6f}.prof'.format(request.endpoint, time.time()),
+    )
+    profile.dump_stats(path)
+    if exception is None:
+        log.info('Profile of %s written to %s', request.full_path, path)
+    else:
+        log.info(
+            'Profile of failed %s written to %s', request.full_path, path
+        )
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Presence data read from CSV file one user at a time.
+"""
+
+from array import array
+
+from presence_analyzer.parsing import MAX_USER_ID
+from presence_analyzer.store import PresenceStore
+
+OFFSET_TYPECODE = 'l'
+
+
+def index_lines(fileobj, start, end, index):
+    """
+    Adds offsets of lines between `start` and `end` offsets to index.
+
+    Index maps user id to array of start offsets of the user's lines. Only
+    user id of every line is looked at, lines without it are skipped.
+
+    Returns tuple of offset just after the last line ending with a
+    newline, number of indexed lines and user id of indexed line which
+    follows the offset or None.
+    """
+    offset = position = start
+    lines = 0
+    pending = None
+    fileobj.seek(start)
+    for line in fileobj:
+        line_start = position
+        position += len(line)
+        if position > end:
+            line = line[:len(line) - (position - end)]
+            position = end
+        if line.endswith('\n'):
+            offset = position
+
+        user_id = line[:line.find(',')]
+        if (
+                not user_id.isdigit() or line.count(',') != 3 or
+                int(user_id) > MAX_USER_ID
+        ):
+            if position >= end:
+                break
+            continue
+        offsets = index.get(int(user_id))
+        if offsets is None:
+            offsets = index[int(user_id)] = array(OFFSET_TYPECODE)
+        offsets.append(line_start)
+        lines += 1
+        if offset != position:
+            pending = int(user_id)
+        if position >= end:
+            break
+    return offset, lines, pending
+
+
+def lines_at(fileobj, offsets, end):
+    """
+    Yields lines of file starting at given offsets, cut at `end` offset.
+
+    File is seeked only when the line does not follow the previous one.
+    """
+    position = None
+    for offset in offsets:
+        if offset != position:
+            fileobj.seek(offset)
+        line = fileobj.readline()
+        position = offset + len(line)
+        if position > end:
+            line = line[:end - offset]
+        yield line
+
+
+class LazyStore(object):
+    """
+    Offset index of CSV file with the interface of PresenceStore.
+
+    Only start offsets of lines of every user are kept in memory, rows of
+    a user are read and parsed when they are asked for. The index takes
+    8 bytes per line regardless of order of lines, e.g. 8 MB for a file
+    of million lines, while PresenceStore keeps 16 bytes per row. Lines
+    of a user are read with one file object, which is seeked between
+    lines that are not adjacent, so on data appended day by day reading a
+    user takes one seek and read per line.
+
+    `read(lines)` yields parsed (user_id, day, start, end) integer tuples
+    of given lines. `end` is offset where indexed part of the file ends,
+    `pending` is user id of incomplete last line of the file, which is
+    indexed but may be finished later.
+    """
+    def __init__(self, path, index, lines, read, end, pending=None):
+        self.path = path
+        self.index = index
+        self.lines = lines
+        self.read = read
+        self.end = end
+        self.pending = pending
+
+    @classmethod
+    def from_file(cls, path, end, read):
+        """
+        Indexes first `end` bytes of CSV file.
+
+        Returns tuple of the store and offset after the last complete line.
+        """
+        index = {}
+        with open(path, 'rb') as csvfile:
+            offset, lines, pending = index_lines(csvfile, 0, end, index)
+        return cls(path, index, lines, read, end, pending), offset
+
+    def extended(self, start, end):
+        """
+        Returns new store with lines between offsets added to the index.
+
+        Start is offset returned with self, so incomplete line indexed
+        before is indexed again. Returns tuple like from_file(), self
+        stays unchanged.
+        """
+        index = dict(self.index)
+        lines = self.lines
+        if self.pending is not None:
+            # drop the incomplete line, array is copied as self uses it
+            offsets = index[self.pending] = array(
+                OFFSET_TYPECODE, index[self.pending][:-1]
+            )
+            if not offsets:
+                del index[self.pending]
+            lines -= 1
+
+        added = {}
+        with open(self.path, 'rb') as csvfile:
+            offset, added_lines, pending = index_lines(
+                csvfile, start, end, added
+            )
+        for user_id, offsets in added.iteritems():
+            if user_id in index:
+                offsets = index[user_id] + offsets
+            index[user_id] = offsets
+        store = LazyStore(
+            self.path, index, lines + added_lines, self.read, end, pending
+        )
+        return store, offset
+
+    def __len__(self):
+        return self.lines
+
+    def __contains__(self, user_id):
+        return user_id in self.index
+
+    def users(self):
+        """
+        Returns sorted list of user ids.
+        """
+        return sorted(self.index)
+
+    def rows(self, user_id):
+        """
+        Yields parsed rows of given user in file order.
+        """
+        offsets = self.index.get(user_id, ())
+        with open(self.path, 'rb') as csvfile:
+            for row in self.read(lines_at(csvfile, offsets, self.end)):
+                yield row
+
+    def user_store(self, user_id):
+        """
+        Returns PresenceStore with rows of given user only.
+        """
+        return PresenceStore.from_rows(self.rows(user_id))
+
+    def weekday_stats(self, user_id, first_day=None, last_day=None):
+        """
+        Aggregates rows of given user, see PresenceStore.weekday_stats().
+        """
+        return self.user_store(user_id).weekday_stats(
+            user_id, first_day, last_day
+        )
+
+    def intervals(self, first_day=None, last_day=None):
+        """
+        Yields (day, start, end) of all users between given days inclusive.
+
+        Rows of all users are read and parsed.
+        """
+        for user_id in self.index:
+            for interval in self.user_store(user_id).intervals(
+                    first_day, last_day
+            ):
+                yield interval
+
+    def user(self, user_id, first_day=None, last_day=None):
+        """
+        Returns presence of given user like PresenceStore.user().
+        """
+        return self.user_store(user_id).user(user_id, first_day, last_day)
+
+    def to_dict(self):
+        """
+        Returns data in the nested dict structure of get_data().
+        """
+        return PresenceStore.from_rows(
+            row for user_id in self.index for row in self.rows(user_id)
+        ).to_dict()
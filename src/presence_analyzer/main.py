@@ -6,3 +6,61 @@ from flask import Flask
 
 
 app = Flask(__name__)  # pylint: disable=invalid-name
+app.config.update(
+    # storage of presence data: 'csv' keeps DATA_CSV parsed in memory,
+    # 'lazy' keeps offsets of lines of every user and parses them on demand,
+    # 'sqlite' imports it into DATA_SQLITE database and queries it there,
+    # 'shared' maps DATA_SHARED published by `bin/flask-ctl publish`
+    DATA_BACKEND='csv',
+    # path of SQLite database used by 'sqlite' DATA_BACKEND
+    DATA_SQLITE=None,
+    # path of snapshot shared by server processes, best put in /dev/shm
+    DATA_SHARED=None,
+    # reuse parsed DATA_CSV until the file changes
+    DATA_CACHE=True,
+    # seconds during which DATA_CSV is not checked for changes
+    DATA_CACHE_TTL=0,
+    # serve previous data while changed DATA_CSV is loaded in background
+    DATA_RELOAD_BACKGROUND=False,
+    # seconds between checks of DATA_CSV in watcher thread, 0 disables it
+    DATA_WATCH_INTERVAL=0,
+    # parse only lines appended to DATA_CSV since it was loaded
+    DATA_INCREMENTAL=True,
+    # path of binary snapshot of parsed DATA_CSV, None disables it
+    DATA_SNAPSHOT=None,
+    # split DATA_CSV read in large chunks, without csv module
+    DATA_CHUNKED_READER=False,
+    # bytes of DATA_CSV read and split at once
+    DATA_READ_CHUNK=1024 * 1024,
+    # processes parsing DATA_CSV, 1 parses it in the serving process; they
+    # are forked once by start_parse_pool() in make_app() and `bin/flask-ctl
+    # publish` before any thread is started, as forking a threaded process
+    # can deadlock, without the pool DATA_CSV is parsed serially
+    DATA_PARSE_WORKERS=1,
+    # seconds after which parsing in processes is given up and DATA_CSV is
+    # parsed serially, e.g. when a process was killed
+    DATA_PARSE_TIMEOUT=300,
+    # smallest DATA_CSV in bytes worth parsing with many processes
+    DATA_PARALLEL_MIN_SIZE=32 * 1024 * 1024,
+    # parse fixed-width dates and times without strptime
+    DATA_FAST_PARSER=True,
+    # Cache-Control header of API responses
+    API_CACHE_CONTROL='no-cache',
+    # number of encoded API responses kept in memory, 0 disables it
+    API_RESPONSE_CACHE_SIZE=1024,
+    # bytes of encoded API responses kept in memory
+    API_RESPONSE_CACHE_BYTES=16 * 1024 * 1024,
+    # compress API responses with gzip, or brotli when it is installed
+    API_COMPRESSION=True,
+    # serve static files compressed at startup, pages refer to them by
+    # fingerprinted names, turn it off to see changes without restarting
+    STATIC_PRECOMPRESS=True,
+    # seconds for which fingerprinted static files are cached by clients
+    STATIC_MAX_AGE=365 * 24 * 60 * 60,
+    # collect timings and counters, add Server-Timing headers, log requests
+    INSTRUMENTATION=False,
+    # dump cProfile stats of every request, in debug mode `?_profile` works
+    PROFILE_REQUESTS=False,
+    # directory of request profiles, None means system temporary directory
+    PROFILE_DIR=None,
+)
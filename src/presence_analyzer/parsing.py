@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Parsers of presence CSV rows.
+"""
+
+from array import array
+from datetime import datetime, date
+
+from presence_analyzer.store import TYPECODE
+
+# user ids have to fit in integer columns of PresenceStore
+MAX_USER_ID = 2 ** (8 * array(TYPECODE).itemsize - 1) - 1
+
+
+def parse_row(row):
+    """
+    Parses `[user_id, date, start, end]` CSV row using strptime.
+
+    Raises ValueError or TypeError for malformed rows.
+    """
+    return (
+        int(row[0]),
+        datetime.strptime(row[1], '%Y-%m-%d').date(),
+        datetime.strptime(row[2], '%H:%M:%S').time(),
+        datetime.strptime(row[3], '%H:%M:%S').time(),
+    )
+
+
+def parse_row_ordinal(row):
+    """
+    Parses CSV row to (user_id, date ordinal, start, end) integers.
+
+    Start and end are given in seconds since midnight. Raises ValueError
+    for user ids which do not fit in PresenceStore.
+    """
+    user_id, day, start, end = parse_row(row)
+    if not -MAX_USER_ID - 1 <= user_id <= MAX_USER_ID:
+        raise ValueError('User id out of range: {0}'.format(user_id))
+    return (
+        user_id,
+        day.toordinal(),
+        start.hour * 3600 + start.minute * 60 + start.second,
+        end.hour * 3600 + end.minute * 60 + end.second,
+    )
+
+
+class OrdinalRowParser(object):
+    """
+    Parses rows in fixed `user_id,YYYY-MM-DD,HH:MM:SS,HH:MM:SS` format.
+
+    Gives the same integers as parse_row_ordinal(), but fields are sliced
+    at fixed positions instead of going through strptime and parsed
+    values are memoized. Anything irregular is handed to
+    parse_row_ordinal().
+    """
+    def __init__(self):
+        self.dates = {}
+        self.times = {}
+
+    def parse_date(self, value):
+        """
+        Returns date ordinal of 'YYYY-MM-DD' string or None.
+        """
+        try:
+            return self.dates[value]
+        except KeyError:
+            pass
+
+        if (
+                len(value) != 10 or value[4] != '-' or value[7] != '-' or
+                not (value[:4] + value[5:7] + value[8:]).isdigit()
+        ):
+            return None
+        try:
+            result = date(
+                int(value[:4]), int(value[5:7]), int(value[8:])
+            ).toordinal()
+        except ValueError:
+            return None
+        self.dates[value] = result
+        return result
+
+    def parse_time(self, value):
+        """
+        Returns seconds since midnight of 'HH:MM:SS' string or None.
+        """
+        try:
+            return self.times[value]
+        except KeyError:
+            pass
+
+        if (
+                len(value) != 8 or value[2] != ':' or value[5] != ':' or
+                not (value[:2] + value[3:5] + value[6:]).isdigit()
+        ):
+            return None
+        hour, minute, second = int(value[:2]), int(value[3:5]), int(value[6:])
+        if not (hour < 24 and minute < 60 and second < 60):
+            return None
+        result = self.times[value] = hour * 3600 + minute * 60 + second
+        return result
+
+    def __call__(self, row):
+        """
+        Parses `[user_id, date, start, end]` CSV row.
+
+        Raises ValueError or TypeError for malformed rows.
+        """
+        user_id = row[0]
+        day = self.parse_date(row[1])
+        start = self.parse_time(row[2])
+        end = self.parse_time(row[3])
+        if (
+                not user_id.isdigit() or None in (day, start, end) or
+                int(user_id) > MAX_USER_ID
+        ):
+            return parse_row_ordinal(row)
+        return int(user_id), day, start, end
+
+
+class ChunkedRowReader(object):
+    """
+    Iterates over rows between `start` and `end` offsets of file.
+
+    File is read in chunks of `chunk_size` bytes, which are split to rows
+    without reading it line by line and without csv module, so quoted
+    fields are not supported. After iteration `offset` is position just
+    after the last line ending with a newline.
+    """
+    def __init__(self, fileobj, start, end, chunk_size=1024 * 1024):
+        self.fileobj = fileobj
+        self.start = start
+        self.end = end
+        self.chunk_size = chunk_size
+        self.offset = start
+
+    def __iter__(self):
+        self.fileobj.seek(self.start)
+        position = self.start
+        pending = ''
+        while position < self.end:
+            chunk = self.fileobj.read(
+                min(self.chunk_size, self.end - position)
+            )
+            if not chunk:
+                break
+            position += len(chunk)
+            last_newline = chunk.rfind('\n')
+            if last_newline == -1:
+                pending += chunk
+                continue
+            self.offset = position - len(chunk) + last_newline + 1
+            lines = (pending + chunk[:last_newline]).split('\n')
+            pending = chunk[last_newline + 1:]
+            for line in lines:
+                yield split_line(line)
+        if pending:
+            yield split_line(pending)
+
+
+def split_line(line):
+    """
+    Splits line without newline to fields, empty line gives no fields.
+    """
+    if line.endswith('\r'):
+        line = line[:-1]
+    return line.split(',') if line else []
@@ -28,8 +28,24 @@ del _buildout_path
 # bin/paster serve parts/etc/deploy.ini
 def make_app(global_conf={}, config=DEPLOY_CFG, debug=False):
     from presence_analyzer import app
+    from presence_analyzer.compression import static_assets
+    from presence_analyzer.utils import start_parse_pool, start_watcher
     app.config.from_pyfile(abspath(config))
     app.debug = debug
+    start_parse_pool()
+    if app.config['STATIC_PRECOMPRESS']:
+        static_assets()
+    start_watcher()
+    return app
+
+
+# use = egg:presence_analyzer#nonblocking in [app:main] of deploy.ini
+def make_nonblocking_app(global_conf={}, config=DEPLOY_CFG, debug=False):
+    """Application which never blocks requests on reloading data"""
+    from presence_analyzer.utils import get_entry
+    app = make_app(global_conf, config, debug)
+    app.config['DATA_RELOAD_BACKGROUND'] = True
+    get_entry()
     return app
 
 
@@ -110,4 +126,40 @@ def run():
         """Stop the application."""
         _serve('stop', dry_run=dry_run)
 
+    # bin/flask-ctl import [--path=CSV]
+    def action_import(path=('p', '')):
+        """Import presence CSV into DATA_SQLITE database.
+
+        Rows are upserted, so the file can be imported repeatedly.
+
+        Options:
+         - '--path' CSV file to import, DATA_CSV by default
+        """
+        from presence_analyzer import app
+        from presence_analyzer.utils import file_signature, load_sqlite
+        app.config.from_pyfile(abspath(DEPLOY_CFG))
+        path = path or app.config['DATA_CSV']
+        database = load_sqlite(path, file_signature(path))[0]
+        print '{0} rows in {1}'.format(len(database), database.path)
+
+    # bin/flask-ctl publish
+    def action_publish(interval=('i', 1.0)):
+        """Publish DATA_CSV as DATA_SHARED snapshot whenever it changes.
+
+        Server processes with DATA_BACKEND = 'shared' map the snapshot,
+        so they share one copy of presence data.
+
+        Options:
+         - '--interval' seconds between checks of DATA_CSV
+        """
+        import time
+        from presence_analyzer import app
+        from presence_analyzer.utils import publish_shared, start_parse_pool
+        app.config.from_pyfile(abspath(DEPLOY_CFG))
+        start_parse_pool()
+        while True:
+            if publish_shared():
+                print 'Published {0}'.format(app.config['DATA_SHARED'])
+            time.sleep(interval)
+
     werkzeug.script.run()
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Compact, column oriented storage of presence data.
+"""
+
+import os
+import mmap
+import ctypes
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Mapping, namedtuple
+from datetime import date, time
+from itertools import izip
+
+from presence_analyzer import aggregation
+
+TYPECODE = 'i'
+DAYS_LIMIT = 4000000  # greater than any date.toordinal()
+
+SNAPSHOT_MAGIC = 'PRESENCE'
+SNAPSHOT_VERSION = 1
+# magic, version, item size, rows, source inode, size and mtime, offset
+# of the last complete line in source and length of tail which follows
+SNAPSHOT_HEADER = struct.Struct('<8sIIqQqdqq')
+
+Snapshot = namedtuple('Snapshot', ['store', 'signature', 'offset', 'tail'])
+
+
+def make_time(seconds):
+    """
+    Converts amount of seconds since midnight to datetime.time.
+    """
+    return time(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class PresenceStore(object):
+    """
+    Presence data kept in four parallel integer columns.
+
+    Columns hold user id, date ordinal (see date.toordinal()) and start and
+    end of presence in seconds since midnight. Rows are sorted by user id
+    and date, so rows of every user form one contiguous slice which
+    `offsets` maps user ids to.
+    """
+    def __init__(self, user_ids, days, starts, ends):
+        """
+        Wraps columns which are already sorted and have unique (user, day).
+        """
+        self.user_ids = user_ids
+        self.days = days
+        self.starts = starts
+        self.ends = ends
+        self.offsets = {}
+
+        low, rows = 0, len(user_ids)
+        while low < rows:
+            user_id = user_ids[low]
+            high = bisect_right(user_ids, user_id, low)
+            self.offsets[user_id] = (low, high)
+            low = high
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Builds store from (user_id, day, start, end) integer tuples.
+
+        Rows may come in any order. When there are more rows for the same
+        user and day, the last one wins.
+        """
+        columns = [array(TYPECODE) for _ in range(4)]
+        user_ids, days, starts, ends = columns
+        for user_id, day, start, end in rows:
+            user_ids.append(user_id)
+            days.append(day)
+            starts.append(start)
+            ends.append(end)
+        return cls.from_columns(*columns)
+
+    @classmethod
+    def from_columns(cls, user_ids, days, starts, ends):
+        """
+        Builds store from unsorted columns, last row wins for duplicates.
+        """
+        previous = -1
+        for user_id, day in izip(user_ids, days):
+            key = user_id * DAYS_LIMIT + day
+            if key <= previous:
+                break
+            previous = key
+        else:
+            return cls(user_ids, days, starts, ends)
+
+        keys = [
+            user_id * DAYS_LIMIT + day
+            for user_id, day in izip(user_ids, days)
+        ]
+        # sort is stable, so the last of duplicated rows stays last
+        order = sorted(xrange(len(keys)), key=keys.__getitem__)
+        order = [
+            index for position, index in enumerate(order)
+            if position + 1 == len(order) or
+            keys[index] != keys[order[position + 1]]
+        ]
+        del keys
+        return cls(*[
+            array(TYPECODE, [column[index] for index in order])
+            for column in (user_ids, days, starts, ends)
+        ])
+
+    def merge(self, rows):
+        """
+        Returns new store with given rows added, self stays unchanged.
+
+        Rows replace existing rows of the same user and day and the last
+        of duplicated rows wins. Returns tuple of new store, list of rows
+        which were added and list of rows which were replaced.
+        """
+        changes = {}
+        for user_id, day, start, end in rows:
+            changes.setdefault(user_id, {})[day] = (start, end)
+
+        sources = (self.user_ids, self.days, self.starts, self.ends)
+        columns = [array(TYPECODE) for _ in sources]
+        user_ids, days, starts, ends = columns
+        added, removed = [], []
+        for user_id in sorted(set(self.offsets) | set(changes)):
+            low, high = self.span(user_id)
+            new = changes.get(user_id, {})
+            if not new or high == low or min(new) > self.days[high - 1]:
+                # appended days, existing rows can be copied as they are
+                for column, source in izip(columns, sources):
+                    column.extend(source[low:high])
+                merged = new
+            else:
+                merged = dict(
+                    (self.days[i], (self.starts[i], self.ends[i]))
+                    for i in xrange(low, high)
+                )
+                for day in new:
+                    if day in merged:
+                        removed.append((user_id, day) + merged[day])
+                merged.update(new)
+
+            for day in sorted(merged):
+                start, end = merged[day]
+                user_ids.append(user_id)
+                days.append(day)
+                starts.append(start)
+                ends.append(end)
+            added.extend(
+                (user_id, day) + new[day] for day in sorted(new)
+            )
+        return PresenceStore(*columns), added, removed
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def __contains__(self, user_id):
+        return user_id in self.offsets
+
+    def users(self):
+        """
+        Returns sorted list of user ids.
+        """
+        return sorted(self.offsets)
+
+    def span(self, user_id, first_day=None, last_day=None):
+        """
+        Returns (low, high) bounds of rows of given user.
+
+        Rows can be limited to days between first_day and last_day date
+        ordinals inclusive, which are found with binary search.
+        """
+        low, high = self.offsets.get(user_id, (0, 0))
+        if first_day is not None:
+            low = bisect_left(self.days, first_day, low, high)
+        if last_day is not None:
+            high = bisect_right(self.days, last_day, low, high)
+        return low, high
+
+    def weekday_stats(self, user_id, first_day=None, last_day=None):
+        """
+        Aggregates rows of given user between given days, see span().
+        """
+        low, high = self.span(user_id, first_day, last_day)
+        return aggregation.weekday_stats(self, low, high)
+
+    def intervals(self, first_day=None, last_day=None):
+        """
+        Yields (day, start, end) of all users between given days inclusive.
+        """
+        for day, start, end in izip(self.days, self.starts, self.ends):
+            if (
+                    (first_day is None or day >= first_day) and
+                    (last_day is None or day <= last_day)
+            ):
+                yield day, start, end
+
+    def user(self, user_id, first_day=None, last_day=None):
+        """
+        Returns presence of given user as date -> {'start', 'end'} mapping.
+
+        Presence can be limited to days between given date ordinals like
+        in span().
+        """
+        low, high = self.span(user_id, first_day, last_day)
+        return UserPresence(self, low, high)
+
+    def to_dict(self):
+        """
+        Returns data in the nested dict structure of get_data().
+        """
+        dates, times = {}, {}
+        data = {}
+        for user_id, (low, high) in self.offsets.iteritems():
+            items = data[user_id] = {}
+            for i in xrange(low, high):
+                day, start, end = self.days[i], self.starts[i], self.ends[i]
+                if day not in dates:
+                    dates[day] = date.fromordinal(day)
+                if start not in times:
+                    times[start] = make_time(start)
+                if end not in times:
+                    times[end] = make_time(end)
+                items[dates[day]] = {'start': times[start], 'end': times[end]}
+        return data
+
+
+class UserPresence(Mapping):
+    """
+    Read-only date -> {'start': time, 'end': time} view of one user's rows.
+    """
+    def __init__(self, store, low, high):
+        self.store = store
+        self.low = low
+        self.high = high
+
+    def __len__(self):
+        return self.high - self.low
+
+    def __iter__(self):
+        days = self.store.days
+        for i in xrange(self.low, self.high):
+            yield date.fromordinal(days[i])
+
+    def __getitem__(self, key):
+        days = self.store.days
+        i = bisect_left(days, key.toordinal(), self.low, self.high)
+        if i == self.high or days[i] != key.toordinal():
+            raise KeyError(key)
+        return {
+            'start': make_time(self.store.starts[i]),
+            'end': make_time(self.store.ends[i]),
+        }
+
+    def rows(self):
+        """
+        Returns iterator of (day, start, end) integer tuples sorted by day.
+        """
+        store, low, high = self.store, self.low, self.high
+        return izip(
+            store.days[low:high], store.starts[low:high], store.ends[low:high]
+        )
+
+
+def save_snapshot(path, snapshot):
+    """
+    Writes Snapshot to binary file, replacing it atomically.
+
+    Header and tail of the source file are followed by raw columns.
+    """
+    store = snapshot.store
+    rows = len(store)
+    header = SNAPSHOT_HEADER.pack(
+        SNAPSHOT_MAGIC, SNAPSHOT_VERSION, array(TYPECODE).itemsize, rows,
+        snapshot.signature[0], snapshot.signature[1], snapshot.signature[2],
+        snapshot.offset, len(snapshot.tail)
+    )
+    padding = -(len(header) + len(snapshot.tail)) % 8
+
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as snapshot_file:
+        snapshot_file.write(header)
+        snapshot_file.write(snapshot.tail)
+        snapshot_file.write('\0' * padding)
+        for column in (store.user_ids, store.days, store.starts, store.ends):
+            if not isinstance(column, array):
+                column = array(TYPECODE, column)
+            column.tofile(snapshot_file)
+    os.rename(tmp_path, path)
+
+
+def load_snapshot(path):
+    """
+    Maps Snapshot written by save_snapshot() into memory.
+
+    Columns of the store are views of the mapped file, so processes
+    loading the same snapshot share its pages. Raises ValueError when
+    file is not a valid snapshot.
+    """
+    with open(path, 'rb') as snapshot_file:
+        header = snapshot_file.read(SNAPSHOT_HEADER.size)
+        if len(header) != SNAPSHOT_HEADER.size:
+            raise ValueError('Truncated snapshot header')
+        (
+            magic, version, itemsize, rows,
+            inode, size, mtime, offset, tail_size,
+        ) = SNAPSHOT_HEADER.unpack(header)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError('Not a presence snapshot')
+        if itemsize != ctypes.sizeof(ctypes.c_int):
+            raise ValueError('Snapshot of other architecture')
+        tail = snapshot_file.read(tail_size)
+
+        start = len(header) + tail_size
+        start += -start % 8
+        column_size = rows * itemsize
+        if os.fstat(snapshot_file.fileno()).st_size != start + 4 * column_size:
+            raise ValueError('Truncated snapshot')
+        # private mapping shares pages with other processes until written
+        mapped = mmap.mmap(
+            snapshot_file.fileno(), 0, access=mmap.ACCESS_COPY
+        )
+
+    column_type = ctypes.c_int * rows
+    columns = [
+        column_type.from_buffer(mapped, start + i * column_size)
+        for i in range(4)
+    ]
+    return Snapshot(
+        PresenceStore(*columns), (inode, size, mtime), offset, tail
+    )
@@ -4,20 +4,54 @@ Presence analyzer unit tests.
 """
 from __future__ import unicode_literals
 
+import os
 import os.path
+import re
+import sys
 import json
+import zlib
+import shutil
+import signal
+import time
 import datetime
+import tempfile
 import unittest
+import threading
 
-from presence_analyzer import main, views, utils
+from presence_analyzer import (
+    aggregation,
+    compression,
+    database,
+    instrumentation,
+    lazy,
+    main,
+    parsing,
+    store,
+    utils,
+    views,
+)
 
 
 TEST_DATA_CSV = os.path.join(
     os.path.dirname(__file__), '..', '..', 'runtime', 'data', 'test_data.csv'
 )
+SAMPLE_DATA_CSV = os.path.join(
+    os.path.dirname(__file__), '..', '..', 'runtime', 'data',
+    'sample_data.csv'
+)
+PARSE_RANGE = utils.parse_range
 
 
-# pylint: disable=maybe-no-member, too-many-public-methods
+def killing_parse_range(task):
+    """
+    Kills parse pool process which got first range of file.
+    """
+    if task[1] == 0:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return PARSE_RANGE(task)
+
+
+# pylint: disable=maybe-no-member, too-many-public-methods, protected-access
 class PresenceAnalyzerViewsTestCase(unittest.TestCase):
     """
     Views tests.
@@ -54,6 +88,149 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         self.assertEqual(len(data), 2)
         self.assertDictEqual(data[0], {'user_id': 10, 'name': 'User 10'})
 
+    def test_status_view(self):
+        """
+        Test information about the last reload.
+        """
+        self.client.get('/api/v1/users')
+        resp = self.client.get('/api/v1/_status')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(data['version'], utils.data_cache.version)
+        self.assertEqual(data['rows'], len(utils.get_store()))
+        self.assertFalse(data['watching'])
+
+    def test_instrumentation(self):
+        """
+        Test Server-Timing header and metrics of instrumented requests.
+        """
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertNotIn('Server-Timing', resp.headers)
+
+        main.app.config['INSTRUMENTATION'] = True
+        instrumentation.metrics.clear()
+        utils.data_cache.clear()
+        utils.response_cache.clear()
+        try:
+            resp = self.client.get('/api/v1/mean_time_weekday/10')
+            timings = resp.headers['Server-Timing'].split(', ')
+            self.assertEqual(
+                [timing.split(';')[0] for timing in timings],
+                ['parse_csv', 'weekday_stats', 'compute', 'encode', 'total'],
+            )
+            resp = self.client.get('/api/v1/_metrics')
+        finally:
+            main.app.config['INSTRUMENTATION'] = False
+        self.assertEqual(resp.mimetype, 'text/plain')
+        lines = resp.data.splitlines()
+        self.assertIn('presence_analyzer_requests_total 1', lines)
+        self.assertIn('presence_analyzer_rows_parsed_total 9', lines)
+        self.assertIn('presence_analyzer_data_rows 9', lines)
+        self.assertIn('presence_analyzer_request_seconds_count 1', lines)
+
+    def test_profile_requests(self):
+        """
+        Test that profiles of requests are written.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        main.app.config.update({'PROFILE_DIR': tmp_dir})
+        try:
+            self.client.get('/api/v1/users?_profile').close()
+            self.assertEqual(os.listdir(tmp_dir), [])
+            main.app.config['PROFILE_REQUESTS'] = True
+            self.client.get('/api/v1/users').close()
+            profiles = os.listdir(tmp_dir)
+
+            main.app.config['DATA_CSV'] = os.path.join(tmp_dir, 'missing')
+            resp = self.client.get('/api/v1/users')
+            self.assertEqual(resp.status_code, 500)
+            failed = set(os.listdir(tmp_dir)) - set(profiles)
+            self.assertIsNone(sys.getprofile())
+        finally:
+            main.app.config.update(
+                {'PROFILE_DIR': None, 'PROFILE_REQUESTS': False}
+            )
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].startswith('users_view-'))
+        self.assertEqual(len(failed), 1)
+
+    def test_occupancy_view(self):
+        """
+        Test numbers of present users in slots of a day.
+        """
+        resp = self.client.get('/api/v1/occupancy?slot=60&from=2013-09-10')
+        self.assertEqual(resp.status_code, 200)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['slots']), 24)
+        self.assertEqual(data['slots'][9], '09:00')
+        self.assertItemsEqual(
+            data['occupancy'].keys(),
+            ['2013-09-10', '2013-09-11', '2013-09-12', '2013-09-13'],
+        )
+        self.assertEqual(
+            data['occupancy']['2013-09-10'][8:19],
+            [0, 2, 2, 2, 2, 2, 1, 1, 1, 1, 0],
+        )
+
+        resp = self.client.get('/api/v1/occupancy?by=weekday&to=2013-09-09')
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['slots']), 96)
+        self.assertItemsEqual(data['occupancy'].keys(), ['Mon', 'Thu'])
+        self.assertEqual(data['occupancy']['Mon'][35:37], [0.0, 1.0])
+
+        for query in ('slot=7', 'slot=0', 'slot=x', 'by=user', 'from=x'):
+            resp = self.client.get('/api/v1/occupancy?' + query)
+            self.assertEqual(resp.status_code, 400)
+
+    def test_rollup_views(self):
+        """
+        Test weekly and monthly presence of users and organisation.
+        """
+        resp = self.client.get('/api/v1/rollup/week')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [
+            ['2013-W36', 22999, 22999.0],
+            ['2013-W37', 173620, 21702.5],
+        ])
+        resp = self.client.get('/api/v1/rollup/month/10')
+        self.assertEqual(json.loads(resp.data), [
+            ['2013-09', 78217, 26072.333333333332],
+        ])
+        for url in ('/api/v1/rollup/year', '/api/v1/rollup/month/12'):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_percentile_views(self):
+        """
+        Test medians and percentiles of users and organisation.
+        """
+        resp = self.client.get('/api/v1/mean_time_weekday/10?stat=median')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [
+            ['Mon', 0], ['Tue', 30000], ['Wed', 24420], ['Thu', 23700],
+            ['Fri', 0], ['Sat', 0], ['Sun', 0],
+        ])
+        resp = self.client.get('/api/v1/presence_start_end/11?stat=p90')
+        self.assertEqual(json.loads(resp.data)[0], ['Mon', 33120, 57240])
+        resp = self.client.get(
+            '/api/v1/presence_start_end/11?stat=p10&from=2013-09-10'
+        )
+        self.assertEqual(json.loads(resp.data)[0], ['Mon', 0, 0])
+
+        resp = self.client.get('/api/v1/mean_time_weekday/all')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)[1], ['Tue', 23305.5])
+        resp = self.client.get('/api/v1/presence_start_end/all?stat=median')
+        self.assertEqual(json.loads(resp.data)[1][0], 'Tue')
+
+        for url in (
+                '/api/v1/mean_time_weekday/10?stat=mode',
+                '/api/v1/presence_start_end/all?stat=p50',
+        ):
+            self.assertEqual(self.client.get(url).status_code, 400)
+        resp = self.client.get('/api/v1/mean_time_weekday/12?stat=median')
+        self.assertEqual(resp.status_code, 404)
+
     def test_mean_time_weekday_view(self):
         mean_time_data = self.client.get('/api/v1/mean_time_weekday/10')
         self.assertEqual(mean_time_data.content_type, 'application/json')
@@ -119,6 +296,233 @@ class PresenceAnalyzerViewsTestCase(unittest.TestCase):
         start_end_data_data = self.client.get('/api/v1/presence_start_end/9')
         self.assertEqual(start_end_data_data.status_code, 404)
 
+    def test_date_range(self):
+        """
+        Test limiting of per-user views to date range.
+        """
+        resp = self.client.get(
+            '/api/v1/presence_weekday/11?from=2013-09-10&to=2013-09-12'
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data), [
+            ['Weekday', 'Presence (s)'],
+            ['Mon', 0],
+            ['Tue', 16564],
+            ['Wed', 25321],
+            ['Thu', 22969],
+            ['Fri', 0],
+            ['Sat', 0],
+            ['Sun', 0],
+        ])
+        resp = self.client.get('/api/v1/mean_time_weekday/11?from=2013-09-13')
+        self.assertEqual(json.loads(resp.data)[4], ['Fri', 6426.0])
+        self.assertEqual(json.loads(resp.data)[0], ['Mon', 0])
+        resp = self.client.get('/api/v1/presence_start_end/10?to=2013-09-01')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.data)[1], ['Tue', 0, 0])
+
+        resp = self.client.get('/api/v1/presence_weekday?to=2013-09-10')
+        self.assertEqual(json.loads(resp.data)['11'][1], ['Mon', 24123])
+        self.assertEqual(json.loads(resp.data)['11'][2], ['Tue', 16564])
+
+        resp = self.client.get('/api/v1/presence_weekday/11?from=13.09.2013')
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get('/api/v1/presence_weekday/9?from=2013-09-13')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_api_users_streamed(self):
+        """
+        Test that users listing is streamed.
+        """
+        resp = self.client.get('/api/v1/users', buffered=False)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(json.loads(b''.join(resp.response)), [
+            {'user_id': 10, 'name': 'User 10'},
+            {'user_id': 11, 'name': 'User 11'},
+        ])
+
+    def test_batch_views(self):
+        """
+        Test that batch views match per-user views.
+        """
+        for name in (
+                'mean_time_weekday', 'presence_weekday', 'presence_start_end'
+        ):
+            resp = self.client.get('/api/v1/{0}?user_id=11,9'.format(name))
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content_type, 'application/json')
+            data = json.loads(resp.data)
+            single = self.client.get('/api/v1/{0}/11'.format(name))
+            self.assertEqual(data, {'11': json.loads(single.data), '9': None})
+
+            resp = self.client.get('/api/v1/{0}'.format(name))
+            self.assertItemsEqual(json.loads(resp.data).keys(), ['10', '11'])
+            resp = self.client.get(
+                '/api/v1/{0}?user_id=10&user_id=11'.format(name)
+            )
+            self.assertItemsEqual(json.loads(resp.data).keys(), ['10', '11'])
+            resp = self.client.get(
+                '/api/v1/{0}?user_id=10,11&user_id=10'.format(name)
+            )
+            self.assertEqual(resp.data.count(b'"10"'), 1)
+
+        resp = self.client.get('/api/v1/presence_weekday?user_id=x')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_conditional_requests(self):
+        """
+        Test that unchanged data is not sent again.
+        """
+        resp = self.client.get('/api/v1/presence_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get(
+            '/api/v1/users', headers={'If-Modified-Since': last_modified}
+        )
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get(
+            '/api/v1/users', headers={'If-None-Match': '"other"'}
+        )
+        self.assertEqual(resp.status_code, 200)
+        # streamed response keeps its context until it is closed
+        resp.close()
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path})
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers={'If-None-Match': etag}
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_compressed_responses(self):
+        """
+        Test that API responses are compressed once per encoding.
+        """
+        utils.response_cache.clear()
+        plain = self.client.get('/api/v1/presence_weekday/10')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        resp = self.client.get('/api/v1/presence_weekday/10', headers=headers)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            zlib.decompress(resp.data, compression.GZIP_WBITS), plain.data
+        )
+        etag = resp.headers['ETag']
+        self.assertEqual(etag, plain.headers['ETag'][:-1] + '-gzip"')
+        self.assertEqual(len(utils.response_cache), 2)
+        cached = self.client.get(
+            '/api/v1/presence_weekday/10', headers=headers
+        )
+        self.assertEqual(cached.data, resp.data)
+        self.assertEqual(len(utils.response_cache), 2)
+
+        resp = self.client.get(
+            '/api/v1/presence_weekday/10',
+            headers=dict(headers, **{'If-None-Match': etag}),
+        )
+        self.assertEqual(resp.status_code, 304)
+
+        streamed = self.client.get('/api/v1/users', headers=headers)
+        self.assertEqual(streamed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            zlib.decompress(streamed.data, compression.GZIP_WBITS),
+            self.client.get('/api/v1/users').data,
+        )
+
+        main.app.config.update({'API_COMPRESSION': False})
+        self.addCleanup(main.app.config.update, {'API_COMPRESSION': True})
+        resp = self.client.get('/api/v1/presence_weekday/10', headers=headers)
+        self.assertEqual(resp.data, plain.data)
+        self.assertNotIn('Vary', resp.headers)
+
+    def test_static_files(self):
+        """
+        Test precompressed static files and their fingerprinted names.
+        """
+        headers = {'Accept-Encoding': 'gzip'}
+        resp = self.client.get(
+            '/static/presence_weekday.html', headers=headers
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['Cache-Control'], 'no-cache')
+        page = zlib.decompress(resp.data, compression.GZIP_WBITS)
+        scripts = re.findall(r'src="(/static/js/jquery\.min\.\w+\.js)"', page)
+        self.assertEqual(len(scripts), 1)
+
+        resp = self.client.get(scripts[0])
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(
+            resp.headers['Cache-Control'],
+            'public, max-age=31536000, immutable',
+        )
+        script = self.client.get('/static/js/jquery.min.js')
+        self.assertEqual(script.data, resp.data)
+        self.assertEqual(script.headers['Cache-Control'], 'no-cache')
+        resp = self.client.get(
+            '/static/js/jquery.min.js',
+            headers={'If-None-Match': script.headers['ETag']},
+        )
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self.client.get('/static/img/loading.gif', headers=headers)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertNotIn('Vary', resp.headers)
+        for url in ('/static/missing.js', '/static/../main.py'):
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+        main.app.config.update({'STATIC_PRECOMPRESS': False})
+        self.addCleanup(main.app.config.update, {'STATIC_PRECOMPRESS': True})
+        resp = self.client.get('/static/presence_weekday.html')
+        self.assertIn(b'/static/js/jquery.min.js', resp.data)
+        resp.close()
+
+    def test_response_cache(self):
+        """
+        Test that encoded responses are reused until data changes.
+        """
+        utils.response_cache.clear()
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        hits = utils.response_cache.hits
+
+        self.addCleanup(
+            setattr, views, 'get_weekday_stats', views.get_weekday_stats
+        )
+        views.get_weekday_stats = None
+        cached = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(cached.data, resp.data)
+        self.assertEqual(utils.response_cache.hits, hits + 1)
+        views.get_weekday_stats = utils.get_weekday_stats
+
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('10,2013-09-10,09:00:00,10:00:00\n')
+        main.app.config.update({'DATA_CSV': path})
+        resp = self.client.get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(json.loads(resp.data)[1], ['Tue', 3600.0])
+        self.assertEqual(len(utils.response_cache), 1)
+
 
 class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
     """
@@ -221,6 +625,350 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         mean_data = utils.mean([])
         self.assertEqual(mean_data, 0)
 
+    def test_get_data_cached(self):
+        """
+        Test that parsed data is reused until CSV file changes.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path})
+
+        data = utils.get_data()
+        self.assertIs(utils.get_data(), data)
+        version = utils.data_cache.version
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-13,10:00:00,15:00:00\n')
+        os.utime(path, (0, 0))
+        new_data = utils.get_data()
+        self.assertIsNot(new_data, data)
+        self.assertItemsEqual(new_data.keys(), [10, 11, 12])
+        self.assertEqual(utils.data_cache.version, version + 1)
+
+        main.app.config.update({'DATA_CACHE': False})
+        self.addCleanup(main.app.config.update, {'DATA_CACHE': True})
+        self.assertIsNot(utils.get_data(), new_data)
+        self.assertEqual(utils.get_data(), new_data)
+
+    def test_data_cache_ttl(self):
+        """
+        Test that file is not checked for changes within TTL.
+        """
+        calls = []
+
+        def loader(path, signature):
+            calls.append(path)
+            return len(calls), signature[1], ''
+
+        cache = utils.DataCache(loader)
+        self.assertEqual(cache.get(TEST_DATA_CSV, ttl=60), 1)
+        cache._entry = cache._entry._replace(signature=None)
+        self.assertEqual(cache.get(TEST_DATA_CSV, ttl=60), 1)
+        self.assertEqual(cache.get(TEST_DATA_CSV), 2)
+        self.assertEqual(cache.get(TEST_DATA_CSV), 2)
+        cache.clear()
+        self.assertEqual(cache.get(TEST_DATA_CSV), 3)
+        self.assertEqual(len(calls), 3)
+
+    def test_background_reload(self):
+        """
+        Test that previous value is returned while file is reloaded.
+        """
+        loading = threading.Event()
+        loaded = threading.Event()
+
+        def loader(path, signature):
+            loading.set()
+            loaded.wait(5)
+            return signature[1], 0, ''
+
+        cache = utils.DataCache(loader)
+        loaded.set()
+        size = cache.get(TEST_DATA_CSV)
+        cache._entry = cache._entry._replace(signature=None)
+        loading.clear()
+        loaded.clear()
+
+        entry = cache.entry(TEST_DATA_CSV, background=True)
+        self.assertEqual(entry.value, size)
+        loading.wait(5)
+        self.assertIs(cache.entry(TEST_DATA_CSV, background=True), entry)
+        loaded.set()
+        cache.wait()
+        self.assertIsNot(cache.entry(TEST_DATA_CSV, background=True), entry)
+        self.assertEqual(cache.version, 2)
+
+    def test_reload_stats(self):
+        """
+        Test that duration and size of the last reload are recorded.
+        """
+        cache = utils.DataCache(utils.load_csv)
+        self.assertEqual(cache.reload_stats, {})
+        cache.get(TEST_DATA_CSV)
+        stats = cache.reload_stats
+        self.assertEqual(stats['version'], 1)
+        self.assertEqual(stats['rows'], 9)
+        self.assertFalse(stats['incremental'])
+        self.assertGreaterEqual(stats['duration'], 0)
+        cache.clear()
+        self.assertEqual(cache.reload_stats, {})
+
+    def test_watcher(self):
+        """
+        Test that watcher reloads changed file off the request path.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path, 'DATA_WATCH_INTERVAL': 0})
+        self.assertIsNone(utils.start_watcher())
+        main.app.config['DATA_WATCH_INTERVAL'] = 0.01
+        watcher = utils.start_watcher()
+        try:
+            self.assertTrue(utils.watcher_running())
+            self.assertIs(utils.start_watcher(), watcher)
+            entry = utils.get_entry()
+            self.assertEqual(entry.path, path)
+
+            signature = utils.file_signature
+            utils.file_signature = None  # requests must not check the file
+            try:
+                self.assertIs(utils.get_store(), entry.value)
+            finally:
+                utils.file_signature = signature
+
+            with open(path, 'a') as csvfile:
+                csvfile.write('\n12,2013-09-10,08:00:00,16:00:00\n')
+            for _ in range(500):
+                if utils.data_cache.version > entry.version:
+                    break
+                time.sleep(0.01)
+            self.assertIn(12, utils.get_store())
+            self.assertEqual(utils.data_cache.reload_stats['rows'], 10)
+        finally:
+            utils.stop_watcher()
+            main.app.config['DATA_WATCH_INTERVAL'] = 0
+            utils.data_cache.clear()
+            shutil.rmtree(tmp_dir)
+        self.assertFalse(utils.watcher_running())
+
+    def test_shared_backend(self):
+        """
+        Test that published snapshot is mapped by serving processes.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        path = os.path.join(tmp_dir, 'data.csv')
+        shared = os.path.join(tmp_dir, 'shared.snapshot')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path, 'DATA_SHARED': shared})
+        try:
+            self.assertTrue(utils.publish_shared())
+            self.assertFalse(utils.publish_shared())
+            data = utils.get_data()
+
+            main.app.config['DATA_BACKEND'] = 'shared'
+            self.assertEqual(utils.data_path(), shared)
+            entry = utils.get_entry()
+            self.assertIsNot(entry.value, utils.data_cache.entry(path).value)
+            self.assertEqual(utils.get_data(), data)
+            self.assertEqual(
+                utils.get_weekday_stats(10),
+                utils.data_cache.entry(path).derived['weekday_stats'][10],
+            )
+
+            with open(path, 'a') as csvfile:
+                csvfile.write('\n12,2013-09-10,08:00:00,16:00:00\n')
+            self.assertIs(utils.get_store(), entry.value)
+            self.assertTrue(utils.publish_shared())
+            self.assertIn(12, utils.get_store())
+            self.assertEqual(utils.shared_cache.version, 2)
+        finally:
+            main.app.config.update({
+                'DATA_CSV': TEST_DATA_CSV,
+                'DATA_BACKEND': 'csv',
+                'DATA_SHARED': None,
+            })
+            utils.shared_cache.clear()
+            utils.data_cache.clear()
+            shutil.rmtree(tmp_dir)
+
+    def test_indexes_built_on_load(self):
+        """
+        Test that indexes are built together with loaded data.
+        """
+        calls = []
+
+        def index(value):
+            calls.append(value)
+            return value * 2
+
+        cache = utils.DataCache(
+            lambda path, signature: (21, 0, ''), {'double': (index, None)}
+        )
+        entry = cache.entry(TEST_DATA_CSV)
+        self.assertEqual(entry.derived, {'double': 42})
+        self.assertIs(cache.entry(TEST_DATA_CSV), entry)
+        self.assertEqual(calls, [21])
+        self.assertEqual(cache.load(TEST_DATA_CSV).version, None)
+
+    def test_uncached_request_loads_once(self):
+        """
+        Test that without caching one request loads data once, unindexed.
+        """
+        loads, builds = [], []
+        self.addCleanup(setattr, utils.data_cache, 'loader', utils.load_csv)
+        utils.data_cache.loader = lambda *args: (
+            loads.append(args) or utils.load_csv(*args)
+        )
+        self.addCleanup(
+            setattr, utils.data_cache, 'indexes', utils.data_cache.indexes
+        )
+        utils.data_cache.indexes = {
+            'weekday_stats': (builds.append, None),
+        }
+        self.addCleanup(main.app.config.update, {'DATA_CACHE': True})
+        main.app.config.update({'DATA_CACHE': False})
+
+        resp = main.app.test_client().get('/api/v1/mean_time_weekday/10')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(builds, [])
+
+    def test_get_weekday_stats(self):
+        """
+        Test precomputed weekday statistics.
+        """
+        stats = utils.get_weekday_stats(10)
+        self.assertEqual(stats.counts, [0, 1, 1, 1, 0, 0, 0])
+        self.assertEqual(stats.intervals, [0, 30047, 24465, 23705, 0, 0, 0])
+        self.assertIs(utils.get_weekday_stats(10), stats)
+        self.assertIsNone(utils.get_weekday_stats(9))
+
+        main.app.config.update({'DATA_CACHE': False})
+        self.addCleanup(main.app.config.update, {'DATA_CACHE': True})
+        self.assertIsNot(utils.get_weekday_stats(10), stats)
+        self.assertEqual(utils.get_weekday_stats(10), stats)
+
+    def test_line_reader(self):
+        """
+        Test reading lines between offsets.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write('first\nsecond\nthi')
+
+        with open(path, 'rb') as csvfile:
+            lines = utils.LineReader(csvfile, 0, 16)
+            self.assertEqual(list(lines), ['first\n', 'second\n', 'thi'])
+            self.assertEqual(lines.offset, 13)
+            lines = utils.LineReader(csvfile, 6, 10)
+            self.assertEqual(list(lines), ['seco'])
+            self.assertEqual(lines.offset, 6)
+            self.assertEqual(utils.read_tail(csvfile, 13), 'first\nsecond\n')
+
+    def test_get_data_incremental(self):
+        """
+        Test that appended lines are merged into already loaded data.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, path)
+        main.app.config.update({'DATA_CSV': path})
+
+        loads = []
+        self.addCleanup(setattr, utils.data_cache, 'loader', utils.load_csv)
+        utils.data_cache.loader = lambda *args: (
+            loads.append(args) or utils.load_csv(*args)
+        )
+        utils.get_store()
+        self.assertEqual(len(loads), 1)
+        self.assertNotIn('rollups', utils.get_entry().derived)
+        utils.get_rollups()
+        utils.get_histograms(10)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write(
+                '\n10,2013-09-10,10:00:00,15:00:00'
+                '\n12,2013-09-13,10:00:00,15:00:00'
+                '\n12,2013-09-14,10:00:00,1'
+            )
+        appended = utils.get_entry()
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(
+            appended.value.user(10)[datetime.date(2013, 9, 10)],
+            {'start': datetime.time(10), 'end': datetime.time(15)}
+        )
+        full = utils.DataCache(utils.load_csv, utils.DATA_INDEXES).entry(path)
+        self.assertEqual(appended.value.to_dict(), full.value.to_dict())
+        full.derive('rollups', aggregation.all_rollups)
+        full.derive('histograms', lambda _: {})[10] = (
+            aggregation.histogram_stats(full.value.user(10).rows())
+        )
+        self.assertEqual(appended.derived, full.derived)
+        self.assertEqual(
+            appended.offset,
+            os.path.getsize(path) - len('12,2013-09-14,10:00:00,1')
+        )
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('6:00:00\n')
+        self.assertEqual(
+            utils.get_store().user(12)[datetime.date(2013, 9, 14)]['end'],
+            datetime.time(16)
+        )
+        self.assertEqual(len(loads), 1)
+
+        with open(path, 'w') as csvfile:
+            csvfile.write('13,2013-09-13,10:00:00,15:00:00\n')
+        self.assertEqual(utils.get_store().users(), [13])
+        self.assertEqual(len(loads), 2)
+
+    def test_dump_items(self):
+        """
+        Test streamed encoding of JSON arrays and objects.
+        """
+        items = [{'user_id': i} for i in range(250)]
+        chunks = list(utils.dump_items(iter(items)))
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(json.loads(''.join(chunks)), items)
+        self.assertEqual(''.join(utils.dump_items([])), '[]')
+
+        pairs = [('1', [1, 2]), ('2', None)]
+        self.assertEqual(
+            json.loads(''.join(utils.dump_pairs(iter(pairs)))), dict(pairs)
+        )
+        self.assertEqual(''.join(utils.dump_pairs([])), '{}')
+
+    def test_lru_cache(self):
+        """
+        Test eviction of least recently used strings.
+        """
+        cache = utils.LRUCache()
+        self.assertIsNone(cache.get('a', 1))
+        cache.put('a', 'aaa', 1, 2, 10)
+        cache.put('b', 'bbb', 1, 2, 10)
+        self.assertEqual(cache.get('a', 1), 'aaa')
+        cache.put('c', 'ccc', 1, 2, 10)
+        self.assertIsNone(cache.get('b', 1))
+        cache.put('d', 'ddddddd', 1, 2, 10)
+        self.assertEqual(cache.stats(), {
+            'items': 2,
+            'bytes': 10,
+            'hits': 1,
+            'misses': 2,
+            'evictions': 2,
+        })
+        cache.put('e', 'e' * 11, 1, 2, 10)
+        cache.put('f', 'f', 0, 2, 10)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('d', 2))
+        self.assertEqual(len(cache), 0)
+
     def test_group_start_end_weekday(self):
         data = utils.get_data()
         start_end_data = utils.group_start_end_weekday(data[10])
@@ -235,6 +983,766 @@ class PresenceAnalyzerUtilsTestCase(unittest.TestCase):
         ])
 
 
+class PresenceAnalyzerParsingTestCase(unittest.TestCase):
+    """
+    CSV parsers tests.
+    """
+
+    def test_load_store_skips_malformed_lines(self):
+        """
+        Test that both parsers skip malformed lines the same way.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                'user_id,date,start,end\n'
+                '10,2013-09-10,09:39:05,17:59:52\n'
+                '10,2013-09-11,xx:19:52,16:07:37\n'
+                '3000000000,2013-09-10,08:00:00,16:00:00\n'
+                '11,2013-09-11,09:19:52,16:07:37\n'
+            )
+        self.addCleanup(main.app.config.update, {'DATA_FAST_PARSER': True})
+        main.app.config.update({'DATA_FAST_PARSER': False})
+        expected = utils.load_store(path).to_dict()
+        main.app.config.update({'DATA_FAST_PARSER': True})
+        self.assertEqual(utils.load_store(path).to_dict(), expected)
+        self.assertItemsEqual(expected.keys(), [10, 11])
+        self.assertItemsEqual(
+            expected[10].keys(), [datetime.date(2013, 9, 10)]
+        )
+
+        for backend in ('csv', 'lazy'):
+            main.app.config.update({'DATA_BACKEND': backend, 'DATA_CSV': path})
+            self.addCleanup(
+                main.app.config.update,
+                {'DATA_BACKEND': 'csv', 'DATA_CSV': TEST_DATA_CSV},
+            )
+            resp = main.app.test_client().get('/api/v1/users')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(json.loads(resp.data)), 2)
+
+    def test_ordinal_row_parser(self):
+        """
+        Test that fast ordinal parser gives the same results as strptime.
+        """
+        parse = parsing.OrdinalRowParser()
+        row = ['10', '2013-09-10', '09:39:05', '17:59:52']
+        self.assertEqual(parse(row), parsing.parse_row_ordinal(row))
+        self.assertEqual(
+            parse(row),
+            (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792)
+        )
+        other = parse(['11', '2013-09-10', '09:39:05', '18:00:00'])
+        self.assertEqual(other[1], parse(row)[1])
+
+        # irregular but valid rows fall back to strptime
+        self.assertEqual(
+            parse(['10', '2013-9-10', '9:39:05', '17:59:52']),
+            parse(row)
+        )
+
+    def test_ordinal_row_parser_malformed(self):
+        """
+        Test that malformed rows are rejected by fast ordinal parser.
+        """
+        parse = parsing.OrdinalRowParser()
+        for row in (
+                ['x', '2013-09-10', '09:39:05', '17:59:52'],
+                ['10', '2013-02-30', '09:39:05', '17:59:52'],
+                ['10', '2013-09-10', '24:00:00', '17:59:52'],
+                ['10', '2013-09-10', '09:39:05', '17-59-52'],
+                ['10', '2013-+9-10', '09:39:05', '17:59:52'],
+                ['3000000000', '2013-09-10', '08:00:00', '16:00:00'],
+                ['-3000000000', '2013-09-10', '08:00:00', '16:00:00'],
+        ):
+            self.assertRaises(ValueError, parse, row)
+
+    def test_chunked_row_reader(self):
+        """
+        Test that chunked reader splits rows like csv module does.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(path, 'w') as csvfile:
+            csvfile.write(
+                'user_id,date,start,end\r\n'
+                '\n'
+                '10,2013-09-10,09:39:05,17:59:52\n'
+                '11,2013-09-11,09:19:52,16:07:37\n'
+                '11,2013-09-12,09:19'
+            )
+        size = os.path.getsize(path)
+
+        with open(path, 'rb') as csvfile:
+            for chunk_size in (1, 10, 1000):
+                for start, end in ((0, size), (0, size - 5), (25, size)):
+                    rows = parsing.ChunkedRowReader(
+                        csvfile, start, end, chunk_size
+                    )
+                    expected = utils.CSVRowReader(csvfile, start, end)
+                    self.assertEqual(list(rows), list(expected))
+                    self.assertEqual(rows.offset, expected.offset)
+
+            # file truncated while it is read
+            rows = parsing.ChunkedRowReader(csvfile, 0, size + 100, 10)
+            self.assertEqual(
+                list(rows), list(utils.CSVRowReader(csvfile, 0, size))
+            )
+
+    def test_load_store_chunked(self):
+        """
+        Test loading of CSV file with chunked reader.
+        """
+        expected = utils.load_store(SAMPLE_DATA_CSV).to_dict()
+        self.addCleanup(
+            main.app.config.update, {'DATA_CHUNKED_READER': False}
+        )
+        main.app.config.update({'DATA_CHUNKED_READER': True})
+        self.assertEqual(
+            utils.load_store(SAMPLE_DATA_CSV).to_dict(), expected
+        )
+
+    def test_parse_csv_parallel(self):
+        """
+        Test that parallel parsing gives the same results as serial one.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        with open(SAMPLE_DATA_CSV) as source, open(path, 'w') as csvfile:
+            csvfile.write(source.read())
+            csvfile.write('10,2011-06-01,10:00:00,11:00:00\n11,2011-06')
+        size = os.path.getsize(path)
+
+        store, offset, tail = utils.parse_csv(path, size)
+        self.addCleanup(main.app.config.update, {
+            'DATA_PARSE_WORKERS': 1,
+            'DATA_PARALLEL_MIN_SIZE': 32 * 1024 * 1024,
+        })
+        main.app.config.update({
+            'DATA_PARSE_WORKERS': 3,
+            'DATA_PARALLEL_MIN_SIZE': 0,
+        })
+        # without started pool the file is parsed serially
+        self.assertEqual(
+            utils.parse_csv(path, size)[0].to_dict(), store.to_dict()
+        )
+        self.assertIsNone(utils.parse_pool)
+
+        self.assertIsNotNone(utils.start_parse_pool())
+        self.addCleanup(utils.stop_parse_pool)
+        result = utils.parse_csv(path, size)
+        self.assertEqual(result[0].to_dict(), store.to_dict())
+        self.assertEqual(result[1:], (offset, tail))
+        self.assertEqual(
+            result[0].user(10)[datetime.date(2011, 6, 1)]['end'],
+            datetime.time(11)
+        )
+
+    def test_parse_csv_killed_worker(self):
+        """
+        Test that file is parsed serially when parse pool process dies.
+        """
+        size = os.path.getsize(SAMPLE_DATA_CSV)
+        store, offset, tail = utils.parse_csv(SAMPLE_DATA_CSV, size)
+        self.addCleanup(main.app.config.update, {
+            'DATA_PARSE_WORKERS': 1,
+            'DATA_PARALLEL_MIN_SIZE': 32 * 1024 * 1024,
+            'DATA_PARSE_TIMEOUT': 300,
+        })
+        main.app.config.update({
+            'DATA_PARSE_WORKERS': 2,
+            'DATA_PARALLEL_MIN_SIZE': 0,
+            'DATA_PARSE_TIMEOUT': 1,
+        })
+        self.addCleanup(utils.stop_parse_pool)
+        self.addCleanup(setattr, utils, 'parse_range', utils.parse_range)
+        utils.parse_range = killing_parse_range
+        pool = utils.start_parse_pool()
+
+        result = utils.parse_csv(SAMPLE_DATA_CSV, size)
+        self.assertEqual(result[0].to_dict(), store.to_dict())
+        self.assertEqual(result[1:], (offset, tail))
+        # the killed pool is replaced by a new one
+        self.assertIsNotNone(utils.parse_pool)
+        self.assertIsNot(utils.parse_pool, pool)
+
+
+class PresenceAnalyzerStoreTestCase(unittest.TestCase):
+    """
+    PresenceStore tests.
+    """
+
+    def test_from_rows(self):
+        """
+        Test that rows are sorted and the last of duplicated rows wins.
+        """
+        presence = store.PresenceStore.from_rows([
+            (11, 735000, 100, 200),
+            (10, 735001, 300, 400),
+            (10, 735000, 500, 600),
+            (11, 735000, 700, 800),
+        ])
+        self.assertEqual(len(presence), 3)
+        self.assertEqual(presence.users(), [10, 11])
+        self.assertEqual(list(presence.user_ids), [10, 10, 11])
+        self.assertEqual(list(presence.days), [735000, 735001, 735000])
+        self.assertEqual(list(presence.starts), [500, 300, 700])
+        self.assertEqual(list(presence.ends), [600, 400, 800])
+        self.assertEqual(presence.span(11), (2, 3))
+        self.assertEqual(presence.span(12), (0, 0))
+        self.assertIn(10, presence)
+        self.assertNotIn(12, presence)
+
+    def test_merge(self):
+        """
+        Test merging rows into store.
+        """
+        presence = store.PresenceStore.from_rows([
+            (10, 735000, 100, 200),
+            (10, 735002, 300, 400),
+            (11, 735000, 500, 600),
+        ])
+        merged, added, removed = presence.merge([
+            (10, 735001, 1, 2),
+            (10, 735002, 3, 4),
+            (11, 735001, 5, 6),
+            (12, 735000, 7, 8),
+            (12, 735000, 9, 10),
+        ])
+        self.assertEqual(len(presence), 3)
+        self.assertEqual(list(merged.user_ids), [10, 10, 10, 11, 11, 12])
+        self.assertEqual(
+            list(merged.days),
+            [735000, 735001, 735002, 735000, 735001, 735000]
+        )
+        self.assertEqual(list(merged.starts), [100, 1, 3, 500, 5, 9])
+        self.assertEqual(merged.span(12), (5, 6))
+        self.assertEqual(added, [
+            (10, 735001, 1, 2),
+            (10, 735002, 3, 4),
+            (11, 735001, 5, 6),
+            (12, 735000, 9, 10),
+        ])
+        self.assertEqual(removed, [(10, 735002, 300, 400)])
+
+    def test_snapshot(self):
+        """
+        Test writing and mapping of binary snapshot.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.snapshot')
+        presence = store.PresenceStore.from_rows([
+            (10, 735000, 100, 200),
+            (11, 735001, 300, 400),
+        ])
+        store.save_snapshot(path, store.Snapshot(
+            presence, (1, 2, 3.5), 4, 'tail'
+        ))
+        snapshot = store.load_snapshot(path)
+        self.assertEqual(snapshot.signature, (1, 2, 3.5))
+        self.assertEqual(snapshot.offset, 4)
+        self.assertEqual(snapshot.tail, 'tail')
+        self.assertEqual(snapshot.store.to_dict(), presence.to_dict())
+        self.assertEqual(snapshot.store.span(11), (1, 2))
+        self.assertEqual(list(snapshot.store.starts), [100, 300])
+
+        with open(path, 'r+b') as snapshot_file:
+            snapshot_file.truncate(os.path.getsize(path) - 1)
+        self.assertRaises(ValueError, store.load_snapshot, path)
+
+    def test_load_csv_snapshot(self):
+        """
+        Test that CSV file is parsed only when snapshot is out of date.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'data.csv')
+        snapshot_path = os.path.join(tmp_dir, 'data.snapshot')
+        shutil.copy(TEST_DATA_CSV, path)
+        self.addCleanup(main.app.config.update, {'DATA_SNAPSHOT': None})
+        main.app.config.update({'DATA_SNAPSHOT': snapshot_path})
+
+        expected = utils.load_store(path).to_dict()
+        snapshot = store.load_snapshot(snapshot_path)
+        self.assertEqual(snapshot.signature, utils.file_signature(path))
+        self.assertEqual(snapshot.store.to_dict(), expected)
+
+        parsed = []
+        self.addCleanup(setattr, utils, 'parse_csv', utils.parse_csv)
+        utils.parse_csv = lambda *args: parsed.append(args)
+        self.assertEqual(utils.load_store(path).to_dict(), expected)
+
+        with open(path, 'a') as csvfile:
+            csvfile.write('\n12,2013-09-13,10:00:00,15:00:00\n')
+        self.assertItemsEqual(utils.load_store(path).users(), [10, 11, 12])
+        self.assertEqual(parsed, [])
+        self.assertItemsEqual(
+            store.load_snapshot(snapshot_path).store.users(), [10, 11, 12]
+        )
+
+    def test_span(self):
+        """
+        Test finding rows of user between dates.
+        """
+        presence = store.PresenceStore.from_rows([
+            (10, 735000, 100, 200),
+            (11, 735000, 100, 200),
+            (11, 735002, 100, 200),
+            (11, 735004, 100, 200),
+        ])
+        self.assertEqual(presence.span(11), (1, 4))
+        self.assertEqual(presence.span(11, 735001), (2, 4))
+        self.assertEqual(presence.span(11, 735002, 735003), (2, 3))
+        self.assertEqual(presence.span(11, None, 735004), (1, 4))
+        self.assertEqual(presence.span(11, 735005), (4, 4))
+        self.assertEqual(presence.span(11, 735003, 735001), (3, 3))
+        self.assertEqual(presence.span(12, 735000, 735004), (0, 0))
+
+    def test_user(self):
+        """
+        Test mapping view of one user's presence.
+        """
+        main.app.config.update({'DATA_CSV': TEST_DATA_CSV})
+        presence = utils.get_store()
+        user = presence.user(10)
+        self.assertEqual(len(user), 3)
+        sample_date = datetime.date(2013, 9, 10)
+        self.assertIn(sample_date, user)
+        self.assertNotIn(datetime.date(2013, 9, 9), user)
+        self.assertEqual(user[sample_date], {
+            'start': datetime.time(9, 39, 5),
+            'end': datetime.time(17, 59, 52),
+        })
+        self.assertEqual(
+            list(user.rows())[0], (sample_date.toordinal(), 34745, 64792)
+        )
+        self.assertEqual(dict(user), utils.get_data()[10])
+
+    def test_to_dict(self):
+        """
+        Test conversion to structure of get_data().
+        """
+        presence = store.PresenceStore.from_rows([
+            (10, datetime.date(2013, 9, 10).toordinal(), 34745, 64792),
+        ])
+        self.assertEqual(presence.to_dict(), {
+            10: {
+                datetime.date(2013, 9, 10): {
+                    'start': datetime.time(9, 39, 5),
+                    'end': datetime.time(17, 59, 52),
+                },
+            },
+        })
+
+
+class PresenceAnalyzerAggregationTestCase(unittest.TestCase):
+    """
+    Aggregation engine tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        main.app.config.update({'DATA_CSV': SAMPLE_DATA_CSV})
+
+    def test_weekday_stats_match_reference(self):
+        """
+        Test that engine gives the same results as grouping functions.
+        """
+        presence = utils.get_store()
+        data = utils.get_data()
+        all_stats = aggregation.all_weekday_stats(presence)
+        self.assertItemsEqual(all_stats.keys(), data.keys())
+        for user_id, items in data.items():
+            stats = presence.weekday_stats(user_id)
+            self.assertEqual(stats, all_stats[user_id])
+
+            intervals = utils.group_by_weekday(items)
+            self.assertEqual(
+                stats.mean_intervals(), [utils.mean(i) for i in intervals]
+            )
+            self.assertEqual(
+                stats.total_intervals(), [sum(i) for i in intervals]
+            )
+            start_end = utils.group_start_end_weekday(items)
+            self.assertEqual(
+                stats.mean_starts(),
+                [utils.mean(day['start']) for day in start_end]
+            )
+            self.assertEqual(
+                stats.mean_ends(),
+                [utils.mean(day['end']) for day in start_end]
+            )
+
+    def test_weekday_stats_add_update(self):
+        """
+        Test adding, removing and merging of rows.
+        """
+        monday = datetime.date(2013, 9, 9).toordinal()
+        stats = aggregation.WeekdayStats()
+        stats.add(monday, 100, 300)
+        stats.add(monday + 1, 100, 200)
+        self.assertEqual(stats.counts, [1, 1, 0, 0, 0, 0, 0])
+        self.assertEqual(stats.mean_intervals(), [200.0, 100.0, 0, 0, 0, 0, 0])
+
+        other = aggregation.WeekdayStats()
+        other.add(monday, 200, 300)
+        other.update(stats)
+        self.assertEqual(other.mean_starts()[0], 150.0)
+        other.add(monday, 200, 300, sign=-1)
+        self.assertEqual(other, stats)
+
+    def test_rollups(self):
+        """
+        Test weekly and monthly rollups and their update.
+        """
+        rollups = utils.get_rollups()
+        for user_id, items in utils.get_data().items():
+            months = {}
+            for day, presence in items.items():
+                bucket = months.setdefault(day.strftime('%Y-%m'), [0, 0])
+                bucket[0] += 1
+                bucket[1] += utils.interval(
+                    presence['start'], presence['end']
+                )
+            self.assertEqual(rollups.users['month'][user_id], months)
+
+        monday = datetime.date(2013, 9, 30).toordinal()
+        rollups = aggregation.Rollups()
+        rollups.add(10, monday, 100, 300)
+        rollups.add(11, monday + 1, 100, 200)
+        self.assertEqual(
+            rollups.report('week'), [('2013-W40', 300, 150.0)]
+        )
+        self.assertEqual(
+            rollups.report('month', 11), [('2013-10', 100, 100.0)]
+        )
+        self.assertIsNone(rollups.report('month', 12))
+
+        updated = rollups.update(
+            [(10, monday, 200, 300), (12, monday, 0, 50)],
+            [(10, monday, 100, 300)],
+        )
+        self.assertEqual(
+            updated.report('month'),
+            [('2013-09', 150, 75.0), ('2013-10', 100, 100.0)],
+        )
+        self.assertEqual(
+            rollups.report('month', 10), [('2013-09', 200, 200.0)]
+        )
+        self.assertEqual(
+            updated.report('month', 10), [('2013-09', 100, 100.0)]
+        )
+
+    def test_histograms(self):
+        """
+        Test percentiles of histograms and their update.
+        """
+        values = [300, 59, 7200, 61, 3600, 120, 125, 86399, 0, 4000]
+        counts = {}
+        for value in values:
+            key = value // aggregation.HISTOGRAM_BIN
+            counts[key] = counts.get(key, 0) + 1
+        histogram = aggregation.Histogram(counts)
+        self.assertEqual(len(histogram), len(values))
+        binned = sorted(
+            value // aggregation.HISTOGRAM_BIN * aggregation.HISTOGRAM_BIN
+            for value in values
+        )
+        for percent in (1, 10, 50, 90, 100):
+            rank = -(-len(values) * percent // 100)
+            self.assertEqual(histogram.percentile(percent), binned[rank - 1])
+        self.assertEqual(aggregation.Histogram().percentile(50), 0)
+        self.assertEqual(histogram.counts(), counts)
+
+        monday = datetime.date(2013, 9, 30).toordinal()
+        stats = aggregation.histogram_stats([
+            (monday, 100, 200), (monday + 7, 200, 400), (monday + 1, 0, 60),
+        ])
+        self.assertEqual(
+            stats.percentiles('intervals', 50), [60, 60, 0, 0, 0, 0, 0]
+        )
+        self.assertEqual(
+            stats.percentiles('ends', 90), [360, 60, 0, 0, 0, 0, 0]
+        )
+        changed = stats.changed([(monday + 7, 200, 400)], sign=-1)
+        self.assertEqual(
+            changed,
+            aggregation.histogram_stats([
+                (monday, 100, 200), (monday + 1, 0, 60),
+            ]),
+        )
+        self.assertIs(changed.starts[1], stats.starts[1])
+
+        store = utils.get_store()
+        first_day = datetime.date(2013, 9, 10)
+        self.assertEqual(
+            utils.get_histograms(11, first_day),
+            aggregation.histogram_stats(
+                row for row in store.user(11).rows()
+                if row[0] >= first_day.toordinal()
+            ),
+        )
+        self.assertEqual(
+            aggregation.update_histograms(
+                {10: aggregation.histogram_stats([])}, store,
+                [(10, monday, 100, 200), (11, monday, 0, 60)], [],
+            ),
+            {10: aggregation.histogram_stats([(monday, 100, 200)])},
+        )
+
+    def test_occupancy(self):
+        """
+        Test that occupancy equals counting of intervals in every slot.
+        """
+        slot = 60 * 60
+        presence = utils.get_store()
+        result = aggregation.occupancy(presence.intervals(), slot)
+        expected = {}
+        for day, start, end in presence.intervals():
+            if end <= start:
+                continue
+            counts = expected.setdefault(day, [0] * (86400 // slot))
+            for index in range(len(counts)):
+                if start < (index + 1) * slot and end > index * slot:
+                    counts[index] += 1
+        self.assertEqual(result, expected)
+
+        monday = datetime.date(2013, 9, 9).toordinal()
+        means = aggregation.weekday_occupancy({
+            monday: [1, 2], monday + 7: [0, 1], monday + 1: [3, 3],
+        })
+        self.assertEqual(means, {0: [0.5, 1.5], 1: [3.0, 3.0]})
+
+
+class PresenceAnalyzerDatabaseTestCase(unittest.TestCase):
+    """
+    SQLite storage tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        main.app.config.update({
+            'DATA_CSV': self.path,
+            'DATA_SQLITE': os.path.join(self.tmp_dir, 'presence.sqlite'),
+        })
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_BACKEND': 'csv',
+            'DATA_SQLITE': None,
+        })
+        utils.sqlite_cache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_import(self):
+        """
+        Test that imported rows are queried like PresenceStore.
+        """
+        sqlite_store, offset, tail = utils.load_sqlite(
+            self.path, utils.file_signature(self.path)
+        )
+        presence_store, csv_offset, csv_tail = utils.load_csv(
+            self.path, utils.file_signature(self.path)
+        )
+        self.assertEqual((offset, tail), (csv_offset, csv_tail))
+        self.assertEqual(len(sqlite_store), 9)
+        self.assertEqual(sqlite_store.users(), [10, 11])
+        self.assertIn(11, sqlite_store)
+        self.assertNotIn(12, sqlite_store)
+        self.assertEqual(sqlite_store.to_dict(), presence_store.to_dict())
+        first_day = datetime.date(2013, 9, 10).toordinal()
+        self.assertItemsEqual(
+            sqlite_store.intervals(first_day),
+            presence_store.intervals(first_day),
+        )
+        for user_id in (10, 11, 12):
+            for days in ((), (first_day, first_day + 1), (None, first_day)):
+                self.assertEqual(
+                    sqlite_store.weekday_stats(user_id, *days),
+                    presence_store.weekday_stats(user_id, *days),
+                )
+
+    def test_upsert(self):
+        """
+        Test that appended and rotated files are upserted.
+        """
+        main.app.config['DATA_BACKEND'] = 'sqlite'
+        self.assertEqual(utils.get_store().users(), [10, 11])
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n10,2013-09-10,08:00:00,16:00:00\n')
+        entry = utils.get_entry()
+        self.assertEqual(len(entry.value), 9)
+        self.assertEqual(
+            entry.value.weekday_stats(10).total_intervals()[1], 8 * 3600
+        )
+        self.assertEqual(utils.sqlite_cache.reload_stats['version'], 2)
+        self.assertTrue(utils.sqlite_cache.reload_stats['incremental'])
+
+        os.remove(self.path)
+        with open(self.path, 'w') as csvfile:
+            csvfile.write('12,2013-09-16,08:00:00,16:00:00\n')
+        self.assertEqual(utils.get_store().users(), [10, 11, 12])
+        source = database.SQLiteStore(main.app.config['DATA_SQLITE']).source()
+        self.assertEqual(source.signature, utils.file_signature(self.path))
+        self.assertEqual(source.offset, os.path.getsize(self.path))
+
+    def test_views(self):
+        """
+        Test that views give the same results with both backends.
+        """
+        client = main.app.test_client()
+        urls = [
+            '/api/v1/users',
+            '/api/v1/mean_time_weekday/10',
+            '/api/v1/presence_weekday/11?from=2013-09-10',
+            '/api/v1/presence_start_end?user_id=10,11,12',
+            '/api/v1/presence_start_end/12',
+        ]
+        results = {}
+        for backend in ('csv', 'sqlite'):
+            main.app.config['DATA_BACKEND'] = backend
+            results[backend] = [
+                (resp.status_code, resp.data)
+                for resp in (client.get(url) for url in urls)
+            ]
+        self.assertEqual(results['sqlite'], results['csv'])
+
+
+class PresenceAnalyzerLazyTestCase(unittest.TestCase):
+    """
+    Lazy loading tests.
+    """
+
+    def setUp(self):
+        """
+        Before each test, set up a environment.
+        """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'data.csv')
+        shutil.copy(TEST_DATA_CSV, self.path)
+        main.app.config.update({
+            'DATA_CSV': self.path,
+            'DATA_BACKEND': 'lazy',
+        })
+
+    def tearDown(self):
+        """
+        Get rid of unused objects after each test.
+        """
+        main.app.config.update({
+            'DATA_CSV': TEST_DATA_CSV,
+            'DATA_BACKEND': 'csv',
+        })
+        utils.lazy_cache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_index_lines(self):
+        """
+        Test that start offset of every line is indexed.
+        """
+        with open(self.path, 'w') as csvfile:
+            csvfile.write(
+                'user_id,date,start,end\n'
+                '10,2013-09-10,09:39:05,17:59:52\n'
+                '10,2013-09-11,09:19:52,16:07:37\n'
+                '11,2013-09-05,09:28:08,15:51:27\n'
+                '10,2013-09-12,10:48:46,17:23:51\n'
+                '11,2013-09-09'
+            )
+        index = {}
+        with open(self.path, 'rb') as csvfile:
+            result = lazy.index_lines(
+                csvfile, 0, os.path.getsize(self.path), index
+            )
+        self.assertEqual(result, (151, 4, None))
+        self.assertEqual(list(index[10]), [23, 55, 119])
+        self.assertEqual(list(index[11]), [87])
+        with open(self.path, 'rb') as csvfile:
+            self.assertEqual(
+                list(lazy.lines_at(csvfile, [55, 119, 23], 151)), [
+                    '10,2013-09-11,09:19:52,16:07:37\n',
+                    '10,2013-09-12,10:48:46,17:23:51\n',
+                    '10,2013-09-10,09:39:05,17:59:52\n',
+                ]
+            )
+            self.assertEqual(
+                list(lazy.lines_at(csvfile, [87, 119], 130)),
+                ['11,2013-09-05,09:28:08,15:51:27\n', '10,2013-09-']
+            )
+
+    def test_get_user_data(self):
+        """
+        Test that data of one user is read from the index.
+        """
+        data = utils.load_store(self.path).to_dict()
+        self.assertEqual(dict(utils.get_user_data(11)), data[11])
+        self.assertIsNone(utils.get_user_data(12))
+        self.assertEqual(len(utils.get_store()), 9)
+        self.assertEqual(utils.get_data(), data)
+        self.assertItemsEqual(
+            utils.get_store().intervals(None, 735120),
+            utils.load_store(self.path).intervals(None, 735120),
+        )
+
+    def test_append(self):
+        """
+        Test that incomplete last line is indexed again when finished.
+        """
+        store = utils.get_store()
+        self.assertEqual(store.pending, 11)
+        with open(self.path, 'a') as csvfile:
+            csvfile.write('\n10,2013-09-10,08:00:00,16:00:00\n12,')
+        store = utils.get_store()
+        self.assertEqual(utils.lazy_cache.version, 2)
+        self.assertEqual(len(store), 10)
+        self.assertIsNone(store.pending)
+        self.assertEqual(
+            store.weekday_stats(10).total_intervals()[1], 8 * 3600
+        )
+        self.assertEqual(
+            store.weekday_stats(11),
+            utils.load_store(self.path).weekday_stats(11),
+        )
+        self.assertNotIn(12, store)
+
+    def test_views(self):
+        """
+        Test that views give the same results as with 'csv' backend.
+        """
+        client = main.app.test_client()
+        urls = [
+            '/api/v1/users',
+            '/api/v1/mean_time_weekday/10',
+            '/api/v1/presence_weekday/11?from=2013-09-10',
+            '/api/v1/presence_start_end?user_id=10,11,12',
+            '/api/v1/presence_start_end/12',
+        ]
+        results = {}
+        for backend in ('csv', 'lazy'):
+            main.app.config['DATA_BACKEND'] = backend
+            results[backend] = [
+                (resp.status_code, resp.data)
+                for resp in (client.get(url) for url in urls)
+            ]
+        self.assertEqual(results['lazy'], results['csv'])
+
+
 def suite():
     """
     Default test suite.
@@ -242,6 +1750,13 @@ def suite():
     base_suite = unittest.TestSuite()
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerViewsTestCase))
     base_suite.addTest(unittest.makeSuite(PresenceAnalyzerUtilsTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerParsingTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerStoreTestCase))
+    base_suite.addTest(
+        unittest.makeSuite(PresenceAnalyzerAggregationTestCase)
+    )
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerDatabaseTestCase))
+    base_suite.addTest(unittest.makeSuite(PresenceAnalyzerLazyTestCase))
     return base_suite
 
 
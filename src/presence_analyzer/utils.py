@@ -4,13 +4,61 @@ Helper functions used in views.
 """
 
 import csv
+import os
+import hashlib
+import threading
+import multiprocessing
+from array import array
 from json import dumps
 from functools import wraps
+from itertools import islice
+from collections import namedtuple, OrderedDict, Sized
 from datetime import datetime
+from time import time as now
 
-from flask import Response
+from flask import (
+    Response,
+    g,
+    has_request_context,
+    request,
+    stream_with_context,
+)
+from werkzeug.http import is_resource_modified
 
+from presence_analyzer.aggregation import (
+    WeekdayStats,
+    all_rollups,
+    all_weekday_stats,
+    histogram_stats,
+    update_all_rollups,
+    update_all_weekday_stats,
+    update_histograms,
+)
+from presence_analyzer.compression import (
+    API_LEVELS,
+    ENCODINGS,
+    accepted_encoding,
+    compress,
+    compress_stream,
+    encoded_etag,
+)
+from presence_analyzer.database import Source, SQLiteStore
+from presence_analyzer.instrumentation import count, timing
+from presence_analyzer.lazy import LazyStore
 from presence_analyzer.main import app
+from presence_analyzer.parsing import (
+    ChunkedRowReader,
+    OrdinalRowParser,
+    parse_row_ordinal,
+    split_line,
+)
+from presence_analyzer.store import (
+    TYPECODE,
+    PresenceStore,
+    Snapshot,
+    load_snapshot,
+    save_snapshot,
+)
 
 import logging
 log = logging.getLogger(__name__)  # pylint: disable=invalid-name
@@ -19,22 +67,753 @@ log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 def jsonify(function):
     """
     Creates a response with the JSON representation of wrapped function result.
+
+    Response is tagged with ETag and Last-Modified of presence data, so
+    conditional requests are answered with 304 without calling function.
+    It is compressed with the best encoding accepted by client.
+    """
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        encoding = api_encoding()
+        return conditional_response(
+            lambda etag: cached_dumps(
+                etag, encoding, function, *args, **kwargs
+            ),
+            encoding,
+        )
+    return inner
+
+
+def jsonify_stream(function):
+    """
+    Creates a streamed response with JSON array of wrapped function items.
+
+    Wrapped function returns iterable, which is encoded item by item while
+    the response is sent, so whole JSON never has to be kept in memory.
+    Only gzip is used for streamed responses.
+    """
+    @wraps(function)
+    def inner(*args, **kwargs):
+        """
+        This docstring will be overridden by @wraps decorator.
+        """
+        encoding = api_encoding(STREAM_ENCODINGS)
+        return conditional_response(
+            lambda etag: stream_with_context(
+                encoded_stream(dump_items(function(*args, **kwargs)), encoding)
+            ),
+            encoding,
+        )
+    return inner
+
+
+def jsonify_stream_object(function):
+    """
+    Creates a streamed response with JSON object of wrapped function pairs.
+
+    Wrapped function returns iterable of (key, value) pairs, which are
+    encoded like in jsonify_stream().
     """
     @wraps(function)
     def inner(*args, **kwargs):
         """
         This docstring will be overridden by @wraps decorator.
         """
-        return Response(
-            dumps(function(*args, **kwargs)),
-            mimetype='application/json'
+        encoding = api_encoding(STREAM_ENCODINGS)
+        return conditional_response(
+            lambda etag: stream_with_context(
+                encoded_stream(dump_pairs(function(*args, **kwargs)), encoding)
+            ),
+            encoding,
         )
     return inner
 
 
+def dump_items(items):
+    """
+    Yields JSON array of items in chunks of STREAM_CHUNK_ITEMS items.
+    """
+    yield '['
+    separator = ''
+    for chunk in chunked(items, STREAM_CHUNK_ITEMS):
+        yield separator + ','.join(dumps(item) for item in chunk)
+        separator = ','
+    yield ']'
+
+
+def dump_pairs(pairs):
+    """
+    Yields JSON object of (key, value) pairs in chunks.
+    """
+    yield '{'
+    separator = ''
+    for chunk in chunked(pairs, STREAM_CHUNK_ITEMS):
+        yield separator + ','.join(
+            '{0}:{1}'.format(dumps(key), dumps(value))
+            for key, value in chunk
+        )
+        separator = ','
+    yield '}'
+
+
+def chunked(items, size):
+    """
+    Yields lists of up to size items.
+    """
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+STREAM_CHUNK_ITEMS = 100
+STREAM_ENCODINGS = ('gzip',)
+
+
+def api_encoding(encodings=ENCODINGS):
+    """
+    Returns encoding of API response or None when it is not compressed.
+    """
+    if not app.config['API_COMPRESSION']:
+        return None
+    return accepted_encoding(encodings)
+
+
+def encoded_stream(chunks, encoding):
+    """
+    Returns chunks compressed with given encoding, None leaves them as is.
+    """
+    if encoding is None:
+        return chunks
+    return compress_stream(chunks)
+
+
+def conditional_response(make_body, encoding=None):
+    """
+    Returns JSON response tagged with ETag and Last-Modified of data.
+
+    make_body(etag) is called only when the client does not have current
+    version of the response already, otherwise 304 is returned. Body made
+    is in given content encoding, which is added to the ETag.
+    """
+    entry = get_entry()
+    version = data_etag(entry)
+    etag = encoded_etag(version, encoding)
+    last_modified = datetime.utcfromtimestamp(int(entry.signature[2]))
+    if is_resource_modified(
+            request.environ, etag=etag, last_modified=last_modified
+    ):
+        response = Response(make_body(version), mimetype='application/json')
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = app.config['API_CACHE_CONTROL']
+    if app.config['API_COMPRESSION']:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def cached_dumps(version, encoding, function, *args, **kwargs):
+    """
+    Returns JSON of function result, reusing it for repeated requests.
+
+    Responses encoded as JSON and compressed with given encoding are kept
+    in response_cache until presence data changes, so every encoding is
+    compressed once per data version. API_RESPONSE_CACHE_SIZE of 0 turns
+    caching off.
+    """
+    max_items = app.config['API_RESPONSE_CACHE_SIZE']
+    if max_items <= 0:
+        return encoded_dumps(encoding, function, *args, **kwargs)
+
+    key = (request.endpoint, request.full_path, encoding)
+    body = response_cache.get(key, version)
+    if body is None:
+        body = encoded_dumps(encoding, function, *args, **kwargs)
+        response_cache.put(
+            key, body, version,
+            max_items, app.config['API_RESPONSE_CACHE_BYTES']
+        )
+    return body
+
+
+def encoded_dumps(encoding, function, *args, **kwargs):
+    """
+    Returns JSON of function result compressed with given encoding.
+    """
+    body = timed_dumps(function, *args, **kwargs)
+    if encoding is None:
+        return body
+    with timing('compress'):
+        return compress(body, encoding, API_LEVELS[encoding])
+
+
+def timed_dumps(function, *args, **kwargs):
+    """
+    Returns JSON of function result, timing computation and encoding.
+    """
+    with timing('compute'):
+        result = function(*args, **kwargs)
+    with timing('encode'):
+        return dumps(result)
+
+
+class LRUCache(object):
+    """
+    Thread-safe least recently used cache of strings of given version.
+
+    All items are dropped when cache is used with a new version. Numbers
+    of hits, misses and evictions are counted.
+    """
+    def __init__(self):
+        self.version = None
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, version):
+        """
+        Returns cached string or None.
+        """
+        with self._lock:
+            if version != self.version:
+                self._clear()
+                self.version = version
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value, version, max_items, max_bytes):
+        """
+        Caches string, evicting least recently used ones over the limits.
+        """
+        with self._lock:
+            if version != self.version or len(value) > max_bytes:
+                return
+            old_value = self._items.pop(key, None)
+            if old_value is not None:
+                self.size -= len(old_value)
+            self._items[key] = value
+            self.size += len(value)
+            while len(self._items) > max_items or self.size > max_bytes:
+                _, old_value = self._items.popitem(last=False)
+                self.size -= len(old_value)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Drops all cached strings.
+        """
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._items.clear()
+        self.size = 0
+
+    def stats(self):
+        """
+        Returns dict with usage counters.
+        """
+        return {
+            'items': len(self._items),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+response_cache = LRUCache()  # pylint: disable=invalid-name
+
+
+def data_etag(entry):
+    """
+    Returns ETag of presence data which is the same in all processes.
+    """
+    return hashlib.md5(
+        repr((app.config['DATA_BACKEND'], entry.signature))
+    ).hexdigest()
+
+
+class CacheEntry(namedtuple('CacheEntry', [
+        'path', 'signature', 'version', 'value', 'checked', 'derived',
+        'offset', 'tail'])):
+    """
+    Value cached by DataCache together with values derived from it.
+
+    `offset` is position in file just after the last line loaded and
+    `tail` holds bytes preceding it.
+    """
+    __slots__ = ()
+
+    def derive(self, key, function):
+        """
+        Returns function(value), computed once for this entry.
+        """
+        try:
+            return self.derived[key]
+        except KeyError:
+            result = self.derived[key] = function(self.value)
+            return result
+
+
+def file_signature(path):
+    """
+    Returns tuple which changes whenever given file is replaced or modified.
+    """
+    stat = os.stat(path)
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+class DataCache(object):
+    """
+    Thread-safe, process-wide cache of a value loaded from a file.
+
+    Cached value is reused as long as inode, size and mtime of the file
+    stay the same. Only one thread at a time runs the loader, other
+    threads wait for it and reuse its result.
+
+    `loader(path, signature)` returns tuple of value, offset and tail.
+
+    `appender(entry, signature)` is called when the file has grown. It returns
+    tuple of updated value, offset, tail and changes passed to index
+    updaters, or None when the file has to be loaded from scratch.
+
+    `indexes` maps names to (build, update) pairs of functions. Indexes
+    are built right after loading, so the value and its indexes are
+    swapped in together. `update(index, value, *changes)` returns index
+    updated after append, when it is None the index is built again.
+
+    `updaters` maps keys of values derived on first use with
+    CacheEntry.derive() to such update functions. After append derived
+    values which were already built are updated, the rest is derived
+    again when needed.
+    """
+    def __init__(self, loader, indexes=None, appender=None, updaters=None):
+        self.loader = loader
+        self.appender = appender
+        self.indexes = indexes if indexes is not None else {}
+        self.updaters = updaters if updaters is not None else {}
+        self.version = 0
+        self._entry = None
+        self._lock = threading.Lock()
+        self._reloader = None
+        self._reloader_lock = threading.Lock()
+        self.reload_stats = {}
+
+    def get(self, path, ttl=0):
+        """
+        Returns value loaded from given path, reloading it when needed.
+
+        For `ttl` seconds after last check the file is not even stat'ed.
+        """
+        return self.entry(path, ttl).value
+
+    def entry(self, path, ttl=0, background=False):
+        """
+        Returns CacheEntry for given path, reloading it when needed.
+
+        With `background` flag changed file is reloaded in another thread
+        and previous entry is returned until the reload is done.
+        """
+        entry = self._entry
+        checked = now()
+        if entry is not None and entry.path == path:
+            if checked - entry.checked < ttl:
+                return entry
+            if entry.signature == file_signature(path):
+                self._entry = entry._replace(checked=checked)
+                return entry
+            if background:
+                self.reload_in_background(path)
+                return entry
+
+        with self._lock:
+            signature = file_signature(path)
+            entry = self._entry
+            started = now()
+            if entry is None or entry.path != path:
+                new_entry = None
+            elif entry.signature == signature:
+                return entry
+            else:
+                new_entry = self.append(entry, signature)
+
+            incremental = new_entry is not None
+            if new_entry is None:
+                new_entry = self.load(path, signature)
+                new_entry.derived.update(
+                    (name, build(new_entry.value))
+                    for name, (build, _) in self.indexes.items()
+                )
+            self.version += 1
+            self._entry = new_entry._replace(version=self.version)
+            finished = now()
+            self.reload_stats = {
+                'version': self.version,
+                'reloaded_at': finished,
+                'duration': finished - started,
+                'rows': (
+                    len(new_entry.value)
+                    if isinstance(new_entry.value, Sized) else None
+                ),
+                'incremental': incremental,
+            }
+            return self._entry
+
+    def reload_in_background(self, path):
+        """
+        Starts thread reloading given path, unless one is running already.
+        """
+        with self._reloader_lock:
+            if self._reloader is not None:
+                return
+            self._reloader = threading.Thread(
+                target=self._reload, args=(path,), name='DataCache reload'
+            )
+            self._reloader.daemon = True
+            self._reloader.start()
+
+    def wait(self):
+        """
+        Waits until background reload is done.
+        """
+        reloader = self._reloader
+        if reloader is not None:
+            reloader.join()
+
+    def _reload(self, path):
+        try:
+            self.entry(path)
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Cannot reload %s', path)
+        finally:
+            with self._reloader_lock:
+                self._reloader = None
+
+    def load(self, path, signature=None):
+        """
+        Loads new CacheEntry, without caching it.
+
+        Indexes are not built, as the entry may be used only once.
+        """
+        if signature is None:
+            signature = file_signature(path)
+        log.debug('Loading %s', path)
+        value, offset, tail = self.loader(path, signature)
+        return CacheEntry(
+            path, signature, None, value, now(), {}, offset, tail
+        )
+
+    def append(self, entry, signature):
+        """
+        Returns new CacheEntry with data appended to the file or None.
+
+        None is returned when the file was replaced, truncated or
+        rewritten, or there is no appender.
+        """
+        inode, size = signature[:2]
+        if (
+                self.appender is None or inode != entry.signature[0] or
+                size <= entry.signature[1]
+        ):
+            return None
+
+        result = self.appender(entry, signature)
+        if result is None:
+            return None
+        log.debug('Appending %d bytes of %s', size - entry.offset, entry.path)
+        value, offset, tail, changes = result
+        derived = {}
+        for name, (build, update) in self.indexes.items():
+            if update is None or name not in entry.derived:
+                derived[name] = build(value)
+            else:
+                derived[name] = update(entry.derived[name], value, *changes)
+        for key, update in self.updaters.items():
+            if key in entry.derived:
+                derived[key] = update(entry.derived[key], value, *changes)
+        return CacheEntry(
+            entry.path, signature, None, value, now(), derived,
+            offset, tail
+        )
+
+    def clear(self):
+        """
+        Drops cached value.
+        """
+        with self._lock:
+            self._entry = None
+            self.reload_stats = {}
+
+
+def get_entry():
+    """
+    Returns CacheEntry of DATA_CSV, loaded only when the file has changed.
+
+    Inside a request the same entry is returned for the whole request,
+    so all its parts see the same data and it is loaded at most once.
+    """
+    if not has_request_context():
+        return load_entry()
+    entry = g.get('data_entry')
+    if entry is None:
+        entry = g.data_entry = load_entry()
+    return entry
+
+
+def load_entry():
+    """
+    Returns current CacheEntry of DATA_CSV.
+
+    Caching can be turned off with DATA_CACHE option. With
+    DATA_RELOAD_BACKGROUND previous data is served while changed file is
+    being loaded. When DataWatcher is running, the file is not checked
+    at all, the watcher reloads it.
+    """
+    path = data_path()
+    cache = current_cache()
+    if not app.config['DATA_CACHE']:
+        return cache.load(path)
+    if watcher_running():
+        ttl = float('inf')
+    else:
+        ttl = app.config['DATA_CACHE_TTL']
+    return cache.entry(path, ttl, app.config['DATA_RELOAD_BACKGROUND'])
+
+
+def current_cache():
+    """
+    Returns DataCache of storage backend selected with DATA_BACKEND.
+    """
+    return DATA_BACKENDS[app.config['DATA_BACKEND']][0]
+
+
+def data_path():
+    """
+    Returns path of file which DATA_BACKEND loads presence data from.
+    """
+    return app.config[DATA_BACKENDS[app.config['DATA_BACKEND']][1]]
+
+
+class DataWatcher(threading.Thread):
+    """
+    Daemon thread polling data file and reloading it when it changes.
+    """
+    def __init__(self, cache, period):
+        super(DataWatcher, self).__init__(name='DataWatcher')
+        self.daemon = True
+        self.cache = cache
+        self.period = period
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.period):
+            try:
+                self.cache.entry(data_path())
+            except Exception:  # pylint: disable=broad-except
+                log.exception('Cannot reload %s', data_path())
+
+    def stop(self):
+        """
+        Stops polling and waits for the thread to finish.
+        """
+        self._stopped.set()
+        self.join()
+
+
+watcher = None  # pylint: disable=invalid-name
+
+
+def watcher_running():
+    """
+    Returns True when DataWatcher is reloading presence data.
+    """
+    return watcher is not None and watcher.is_alive()
+
+
+def start_watcher():
+    """
+    Loads presence data and starts DataWatcher if DATA_WATCH_INTERVAL > 0.
+
+    Returns the watcher, which runs until stop_watcher() is called.
+    """
+    global watcher  # pylint: disable=global-statement,invalid-name
+    period = app.config['DATA_WATCH_INTERVAL']
+    if period <= 0 or watcher_running():
+        return watcher
+    cache = current_cache()
+    cache.entry(data_path())
+    watcher = DataWatcher(cache, period)
+    watcher.start()
+    return watcher
+
+
+def stop_watcher():
+    """
+    Stops running DataWatcher.
+    """
+    global watcher  # pylint: disable=global-statement,invalid-name
+    if watcher is not None:
+        watcher.stop()
+        watcher = None
+
+
+def get_store():
+    """
+    Returns PresenceStore or SQLiteStore with presence data.
+    """
+    return get_entry().value
+
+
+def get_user_data(user_id):
+    """
+    Returns presence of one user as date -> {'start', 'end'} mapping.
+
+    Returns None when there is no such user. With 'lazy' and 'sqlite'
+    DATA_BACKEND only rows of the user are read.
+    """
+    store = get_store()
+    if user_id not in store:
+        return None
+    return store.user(user_id)
+
+
+def get_rollups():
+    """
+    Returns Rollups of presence data per week and month.
+
+    Rollups are built on first use of every version of data, with csv
+    backend they are updated when lines are appended.
+    """
+    return get_entry().derive('rollups', all_rollups)
+
+
+def get_weekday_stats(user_id, date_from=None, date_to=None):
+    """
+    Returns WeekdayStats of given user or None if there is no such user.
+    """
+    entry = get_entry()
+    with timing('weekday_stats'):
+        return entry_weekday_stats(entry, user_id, date_from, date_to)
+
+
+def entry_weekday_stats(entry, user_id, date_from=None, date_to=None):
+    """
+    Returns WeekdayStats of given user from CacheEntry or None.
+
+    Without date range precomputed stats are returned when there are any,
+    otherwise only rows of the user between given dates inclusive are
+    aggregated.
+    """
+    if (
+            date_from is None and date_to is None and
+            'weekday_stats' in entry.derived
+    ):
+        return entry.derived['weekday_stats'].get(user_id)
+
+    store = entry.value
+    if user_id not in store:
+        return None
+    return store.weekday_stats(user_id, *day_range(date_from, date_to))
+
+
+def get_histograms(user_id, date_from=None, date_to=None):
+    """
+    Returns HistogramStats of given user or None if there is no such user.
+
+    Without date range histograms of the user are built on first use of
+    every version of data and kept, with csv backend they are updated
+    when lines are appended. Otherwise only rows of the user between
+    given dates inclusive are counted.
+    """
+    entry = get_entry()
+    store = entry.value
+    if user_id not in store:
+        return None
+    if date_from is not None or date_to is not None:
+        return histogram_stats(
+            store.user(user_id, *day_range(date_from, date_to)).rows()
+        )
+
+    histograms = entry.derive('histograms', lambda _: {})
+    stats = histograms.get(user_id)
+    if stats is None:
+        stats = histograms[user_id] = histogram_stats(
+            store.user(user_id).rows()
+        )
+    return stats
+
+
+def get_organisation_stats(date_from=None, date_to=None):
+    """
+    Returns (WeekdayStats, HistogramStats) of all users together.
+
+    Without date range they are computed once per version of data,
+    otherwise rows between given dates are aggregated.
+    """
+    entry = get_entry()
+    if date_from is not None or date_to is not None:
+        return interval_stats(
+            entry.value.intervals(*day_range(date_from, date_to))
+        )
+    return entry.derive(
+        'organisation_stats',
+        lambda store: interval_stats(store.intervals()),
+    )
+
+
+def interval_stats(intervals):
+    """
+    Returns (WeekdayStats, HistogramStats) of (day, start, end) rows.
+    """
+    stats = WeekdayStats()
+
+    def counted():
+        """
+        Yields rows while adding them to weekday stats.
+        """
+        for day, start, end in intervals:
+            stats.add(day, start, end)
+            yield day, start, end
+
+    histograms = histogram_stats(counted())
+    return stats, histograms
+
+
+def day_range(date_from, date_to):
+    """
+    Returns date ordinals of given dates, None stays None.
+    """
+    return tuple(
+        day.toordinal() if day is not None else None
+        for day in (date_from, date_to)
+    )
+
+
 def get_data():
     """
-    Extracts presence data from CSV file and groups it by user_id.
+    Returns presence data grouped by user_id.
 
     It creates structure like this:
     data = {
@@ -49,26 +828,519 @@ def get_data():
             },
         }
     }
+
+    Returned structure is shared between threads and must not be modified.
+    It takes much more memory than PresenceStore from get_store().
     """
-    data = {}
-    with open(app.config['DATA_CSV'], 'r') as csvfile:
-        presence_reader = csv.reader(csvfile, delimiter=',')
-        for i, row in enumerate(presence_reader):
-            if len(row) != 4:
-                # ignore header and footer lines
-                continue
+    entry = get_entry()
+    with timing('get_data'):
+        return entry.derive('data', lambda store: store.to_dict())
 
-            try:
-                user_id = int(row[0])
-                date = datetime.strptime(row[1], '%Y-%m-%d').date()
-                start = datetime.strptime(row[2], '%H:%M:%S').time()
-                end = datetime.strptime(row[3], '%H:%M:%S').time()
-            except (ValueError, TypeError):
-                log.debug('Problem with line %d: ', i, exc_info=True)
 
-            data.setdefault(user_id, {})[date] = {'start': start, 'end': end}
+def load_store(path):
+    """
+    Extracts presence data from CSV file into PresenceStore.
+    """
+    return load_csv(path, file_signature(path))[0]
+
+
+def row_parser():
+    """
+    Returns function parsing CSV rows to integer tuples.
+    """
+    if app.config['DATA_FAST_PARSER']:
+        return OrdinalRowParser()
+    return parse_row_ordinal
+
+
+def load_csv(path, signature):
+    """
+    Loads CSV file with given signature into PresenceStore.
+
+    When DATA_SNAPSHOT is set, store is mapped from binary snapshot of the
+    file, which is written after every parse. Returns tuple of store,
+    offset just after the last complete line and bytes preceding it.
+    """
+    snapshot_path = app.config['DATA_SNAPSHOT']
+    if not snapshot_path:
+        return parse_csv(path, signature[1])
+
+    snapshot = read_snapshot(snapshot_path)
+    if snapshot is not None and snapshot.signature == signature:
+        log.debug('Using snapshot %s', snapshot_path)
+        return snapshot.store, snapshot.offset, snapshot.tail
+
+    result = None
+    if (
+            snapshot is not None and app.config['DATA_INCREMENTAL'] and
+            snapshot.signature[0] == signature[0] and
+            snapshot.signature[1] < signature[1]
+    ):
+        result = append_lines(
+            path, snapshot.store, snapshot.offset, snapshot.tail,
+            signature[1]
+        )
+    if result is None:
+        result = parse_csv(path, signature[1])
+    store, offset, tail = result[:3]
+
+    try:
+        save_snapshot(snapshot_path, Snapshot(store, signature, offset, tail))
+    except (IOError, OSError):
+        log.warning('Cannot write snapshot %s', snapshot_path, exc_info=True)
+    return store, offset, tail
+
+
+def load_sqlite(path, signature):
+    """
+    Imports CSV file with given signature into DATA_SQLITE database.
+
+    Rows are upserted, so rows which are not in the file anymore stay in
+    the database and history survives rotation of DATA_CSV. When the file
+    was appended to since the last import, only new lines are read.
+    Returns tuple of SQLiteStore, offset and tail like load_csv().
+    """
+    database = SQLiteStore(app.config['DATA_SQLITE'])
+    source = database.source()
+    if source is not None and source.signature == signature:
+        return database, source.offset, source.tail
+
+    result = None
+    if (
+            source is not None and app.config['DATA_INCREMENTAL'] and
+            source.signature[0] == signature[0] and
+            source.signature[1] < signature[1]
+    ):
+        result = import_lines(
+            path, database, source.offset, source.tail, signature
+        )
+    if result is None:
+        result = import_lines(path, database, 0, '', signature)
+    return result[:3]
+
+
+def append_sqlite(entry, signature):
+    """
+    Imports lines appended to CSV file into database of entry.
+
+    Returns None when DATA_INCREMENTAL is off or the file was rewritten.
+    """
+    if not app.config['DATA_INCREMENTAL']:
+        return None
+    return import_lines(
+        entry.path, entry.value, entry.offset, entry.tail, signature
+    )
+
+
+def import_lines(path, database, offset, tail, signature):
+    """
+    Upserts lines of CSV file following offset into SQLiteStore.
+
+    Returns tuple of database, offset, tail and no index changes, or None
+    when bytes preceding offset are not equal to tail anymore.
+    """
+    size = signature[1]
+    with open(path, 'rb') as csvfile:
+        if read_tail(csvfile, offset) != tail:
+            log.info('%s was rewritten, importing it again', path)
+            return None
+
+        with timing('import_lines'):
+            rows = row_reader(csvfile, offset, size)
+            imported = database.upsert(read_rows(rows, row_parser()))
+            tail = read_tail(csvfile, rows.offset)
+        database.set_source(Source(signature, rows.offset, tail))
+        count('bytes_read', size - offset)
+        count('rows_parsed', imported)
+        return database, rows.offset, tail, ()
+
+
+def load_lazy(path, signature):
+    """
+    Builds LazyStore, an index of lines of every user in CSV file.
+
+    Returns tuple of LazyStore, offset and tail like load_csv().
+    """
+    with timing('index_lines'):
+        store, offset = LazyStore.from_file(path, signature[1], parse_lines)
+    with open(path, 'rb') as csvfile:
+        tail = read_tail(csvfile, offset)
+    count('bytes_read', signature[1])
+    return store, offset, tail
+
+
+def append_lazy(entry, signature):
+    """
+    Adds lines appended to CSV file since it was indexed to LazyStore.
+
+    Returns None when DATA_INCREMENTAL is off or the file was rewritten.
+    """
+    if not app.config['DATA_INCREMENTAL']:
+        return None
+    with open(entry.path, 'rb') as csvfile:
+        if read_tail(csvfile, entry.offset) != entry.tail:
+            log.info('%s was rewritten, indexing it again', entry.path)
+            return None
+        store, offset = entry.value.extended(entry.offset, signature[1])
+        tail = read_tail(csvfile, offset)
+    count('bytes_read', signature[1] - entry.offset)
+    return store, offset, tail, ()
+
+
+def parse_lines(lines):
+    """
+    Yields parsed rows of given CSV lines, used by LazyStore.
+
+    Lines are split like in row_reader() depending on DATA_CHUNKED_READER.
+    """
+    if app.config['DATA_CHUNKED_READER']:
+        rows = (split_line(line.rstrip('\n')) for line in lines)
+    else:
+        rows = csv.reader(lines, delimiter=',')
+    return read_rows(rows, row_parser())
+
+
+def load_shared(path, signature):
+    """
+    Maps snapshot published by publish_shared() into memory.
+
+    Snapshot columns are not copied, so all processes share one copy of
+    presence data. Returns tuple like load_csv().
+    """
+    # pylint: disable=unused-argument
+    return load_snapshot(path).store, 0, ''
+
+
+def publish_shared():
+    """
+    Loads DATA_CSV and publishes it as DATA_SHARED snapshot when changed.
+
+    Snapshot is replaced atomically, processes which mapped the previous
+    one keep using it until they notice new inode of DATA_SHARED. Returns
+    True when new version was published.
+    """
+    path = app.config['DATA_SHARED']
+    entry = data_cache.entry(app.config['DATA_CSV'])
+    snapshot = read_snapshot(path)
+    if snapshot is not None and snapshot.signature == entry.signature:
+        return False
+    with timing('publish_shared'):
+        save_snapshot(path, Snapshot(
+            entry.value, entry.signature, entry.offset, entry.tail
+        ))
+    log.info('Published version %d of %s', entry.version, path)
+    return True
+
+
+def read_snapshot(path):
+    """
+    Returns Snapshot loaded from given path or None.
+    """
+    try:
+        return load_snapshot(path)
+    except (IOError, OSError, ValueError):
+        log.debug('Cannot read snapshot %s', path, exc_info=True)
+        return None
+
+
+def parse_csv(path, size):
+    """
+    Parses first `size` bytes of CSV file into PresenceStore.
+
+    Files of at least DATA_PARALLEL_MIN_SIZE bytes are parsed by pool
+    started with start_parse_pool(). Returns tuple like load_csv().
+    """
+    workers = app.config['DATA_PARSE_WORKERS']
+    with timing('parse_csv'):
+        if workers > 1 and parse_pool is None:
+            log.warning(
+                'DATA_PARSE_WORKERS ignored, parse pool was not started'
+            )
+        result = None
+        if (
+                parse_pool is not None and
+                size >= app.config['DATA_PARALLEL_MIN_SIZE']
+        ):
+            result = parse_csv_parallel(path, size, workers)
+        if result is None:
+            with open(path, 'rb') as csvfile:
+                rows = row_reader(csvfile, 0, size)
+                store = PresenceStore.from_rows(
+                    read_rows(rows, row_parser())
+                )
+                result = store, rows.offset, read_tail(csvfile, rows.offset)
+    count('bytes_read', size)
+    count('rows_parsed', len(result[0]))
+    return result
+
+
+parse_pool = None  # pylint: disable=invalid-name
+
+
+def start_parse_pool():
+    """
+    Starts pool of DATA_PARSE_WORKERS processes parsing DATA_CSV.
+
+    Pool has to be started before any other thread, because a lock held
+    by a thread while processes are forked stays locked in them forever.
+    Returns the pool, which runs until stop_parse_pool() is called, or
+    None when DATA_PARSE_WORKERS is 1.
+    """
+    global parse_pool  # pylint: disable=global-statement,invalid-name
+    workers = app.config['DATA_PARSE_WORKERS']
+    if workers <= 1 or parse_pool is not None:
+        return parse_pool
+    if threading.active_count() > 1:
+        log.warning('Parse pool started while other threads are running')
+    parse_pool = multiprocessing.Pool(workers)
+    return parse_pool
+
+
+def restart_parse_pool():
+    """
+    Terminates parse pool and starts a new one if no other thread runs.
+
+    Otherwise DATA_CSV is parsed serially until the process is restarted.
+    """
+    global parse_pool  # pylint: disable=global-statement,invalid-name
+    pool, parse_pool = parse_pool, None
+    if pool is not None:
+        pool.terminate()
+        pool.join()
+    if threading.active_count() > 1:
+        log.error('Parse pool stopped, DATA_CSV will be parsed serially')
+        return None
+    return start_parse_pool()
+
+
+def stop_parse_pool():
+    """
+    Stops pool started with start_parse_pool().
+    """
+    global parse_pool  # pylint: disable=global-statement,invalid-name
+    if parse_pool is not None:
+        parse_pool.close()
+        parse_pool.join()
+        parse_pool = None
+
+
+def parse_csv_parallel(path, size, workers):
+    """
+    Parses CSV file split into newline aligned ranges in parse_pool.
+
+    Ranges are merged in file order, so the last of duplicated rows wins
+    just like in serial parsing. Returns None when a worker failed or did
+    not finish in DATA_PARSE_TIMEOUT seconds, e.g. because it was killed,
+    the pool is restarted then.
+    """
+    with open(path, 'rb') as csvfile:
+        bounds = [0]
+        for i in range(1, workers):
+            csvfile.seek(size * i // workers)
+            csvfile.readline()
+            bounds.append(min(csvfile.tell(), size))
+        bounds.append(size)
+        tasks = [
+            (
+                path, start, end, app.config['DATA_FAST_PARSER'],
+                app.config['DATA_CHUNKED_READER'] and
+                app.config['DATA_READ_CHUNK'],
+            )
+            for start, end in zip(bounds, bounds[1:]) if start < end
+        ]
+
+        try:
+            results = parse_pool.map_async(parse_range, tasks).get(
+                app.config['DATA_PARSE_TIMEOUT']
+            )
+        except Exception:  # pylint: disable=broad-except
+            log.exception('Cannot parse %s in parse pool', path)
+            restart_parse_pool()
+            return None
+        columns = [array(TYPECODE) for _ in range(4)]
+        offset = 0
+        for chunks, offset in results:
+            for column, chunk in zip(columns, chunks):
+                column.fromstring(chunk)
+        store = PresenceStore.from_columns(*columns)
+        return store, offset, read_tail(csvfile, offset)
+
+
+def parse_range(task):
+    """
+    Parses range of CSV file in pool process.
+
+    Returns serialized columns of parsed rows and offset just after the
+    last complete line.
+    """
+    path, low, high, fast_parser, read_chunk = task
+    parse = OrdinalRowParser() if fast_parser else parse_row_ordinal
+    columns = [array(TYPECODE) for _ in range(4)]
+    user_ids, days, starts, ends = columns
+    with open(path, 'rb') as csvfile:
+        if read_chunk:
+            rows = ChunkedRowReader(csvfile, low, high, read_chunk)
+        else:
+            rows = CSVRowReader(csvfile, low, high)
+        for user_id, day, start, end in read_rows(rows, parse):
+            user_ids.append(user_id)
+            days.append(day)
+            starts.append(start)
+            ends.append(end)
+    return [column.tostring() for column in columns], rows.offset
+
+
+def append_csv(entry, signature):
+    """
+    Merges lines appended to CSV file since it was loaded into entry.
+
+    Returns None when DATA_INCREMENTAL is off or the whole file has to be
+    loaded again.
+    """
+    if not app.config['DATA_INCREMENTAL']:
+        return None
+    return append_lines(
+        entry.path, entry.value, entry.offset, entry.tail, signature[1]
+    )
+
+
+def append_lines(path, store, offset, tail, size):
+    """
+    Merges lines between offset and size of CSV file into store.
+
+    Returns tuple of new store, offset, tail and (added, removed) rows or
+    None when bytes preceding offset are not equal to tail anymore.
+    """
+    with open(path, 'rb') as csvfile:
+        if read_tail(csvfile, offset) != tail:
+            log.info('%s was rewritten, loading it again', path)
+            return None
+
+        with timing('append_lines'):
+            rows = row_reader(csvfile, offset, size)
+            store, added, removed = store.merge(
+                read_rows(rows, row_parser())
+            )
+            tail = read_tail(csvfile, rows.offset)
+        count('bytes_read', size - offset)
+        count('rows_parsed', len(added))
+        return store, rows.offset, tail, (added, removed)
+
+
+def read_tail(fileobj, offset):
+    """
+    Returns up to TAIL_SIZE bytes preceding offset.
+    """
+    start = max(0, offset - TAIL_SIZE)
+    fileobj.seek(start)
+    return fileobj.read(offset - start)
+
+
+def row_reader(fileobj, start, end):
+    """
+    Returns reader of CSV rows between `start` and `end` offsets of file.
+
+    With DATA_CHUNKED_READER option rows are split from large chunks of
+    file without csv module, which is faster but does not support quoted
+    fields.
+    """
+    if app.config['DATA_CHUNKED_READER']:
+        return ChunkedRowReader(
+            fileobj, start, end, app.config['DATA_READ_CHUNK']
+        )
+    return CSVRowReader(fileobj, start, end)
+
+
+class LineReader(object):
+    """
+    Iterates over lines of file between `start` and `end` offsets.
+
+    After iteration `offset` is position just after the last line ending
+    with a newline. Incomplete last line will be read again next time.
+    """
+    def __init__(self, fileobj, start, end):
+        self.fileobj = fileobj
+        self.start = start
+        self.end = end
+        self.offset = start
+
+    def __iter__(self):
+        position = self.start
+        self.fileobj.seek(position)
+        for line in self.fileobj:
+            position += len(line)
+            if position > self.end:
+                line = line[:len(line) - (position - self.end)]
+                position = self.end
+            if line.endswith('\n'):
+                self.offset = position
+            yield line
+            if position >= self.end:
+                break
+
+
+class CSVRowReader(LineReader):
+    """
+    Iterates over CSV rows between `start` and `end` offsets of file.
+    """
+    def __iter__(self):
+        return csv.reader(super(CSVRowReader, self).__iter__(), delimiter=',')
+
+
+def read_rows(presence_reader, parse):
+    """
+    Yields CSV rows parsed with given function, skips bad lines.
+    """
+    for i, row in enumerate(presence_reader):
+        if len(row) != 4:
+            # ignore header and footer lines
+            continue
+
+        try:
+            yield parse(row)
+        except (ValueError, TypeError):
+            log.debug('Problem with line %d: ', i, exc_info=True)
+            count('rows_rejected')
+
+
+TAIL_SIZE = 64
+
+# names of indexes of PresenceStore and their (build, update) functions
+DATA_INDEXES = {
+    'weekday_stats': (all_weekday_stats, update_all_weekday_stats),
+}
+# values derived from PresenceStore on first use and their update functions,
+# they are not built at load, as every process would keep its own copy
+DATA_UPDATERS = {
+    'histograms': update_histograms,
+    'rollups': update_all_rollups,
+}
+
+data_cache = DataCache(  # pylint: disable=invalid-name
+    load_csv, DATA_INDEXES, append_csv, DATA_UPDATERS
+)
+# SQLite answers queries of single users, no indexes are kept in memory
+sqlite_cache = DataCache(  # pylint: disable=invalid-name
+    load_sqlite, {}, append_sqlite
+)
+
+# only offsets of lines are kept, rows are parsed when they are needed
+lazy_cache = DataCache(  # pylint: disable=invalid-name
+    load_lazy, {}, append_lazy
+)
+
+# snapshot published by another process, mapped by all serving processes
+shared_cache = DataCache(  # pylint: disable=invalid-name
+    load_shared, DATA_INDEXES
+)
 
-    return data
+# DataCache of every DATA_BACKEND and option with path of its data file
+DATA_BACKENDS = {
+    'csv': (data_cache, 'DATA_CSV'),
+    'lazy': (lazy_cache, 'DATA_CSV'),
+    'shared': (shared_cache, 'DATA_SHARED'),
+    'sqlite': (sqlite_cache, 'DATA_CSV'),
+}
 
 
 def group_by_weekday(items):
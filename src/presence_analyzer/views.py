@@ -4,15 +4,44 @@ Defines views.
 """
 
 import calendar
-from flask import redirect, abort
+from collections import OrderedDict
+from datetime import date, datetime
+from json import dumps
 
+from flask import Response, redirect, abort, request
+from werkzeug.http import is_resource_modified
+
+from presence_analyzer.aggregation import (
+    PERCENTILES,
+    PERIODS,
+    SECONDS_PER_DAY,
+    occupancy,
+    weekday_occupancy,
+)
+from presence_analyzer.compression import (
+    ENCODINGS,
+    accepted_encoding,
+    encoded_etag,
+    static_assets,
+)
+from presence_analyzer.instrumentation import metrics
 from presence_analyzer.main import app
 from presence_analyzer.utils import (
-    get_data,
-    group_by_weekday,
-    group_start_end_weekday,
+    current_cache,
+    day_range,
+    entry_weekday_stats,
+    get_data,  # pylint: disable=unused-import
+    get_entry,
+    get_histograms,
+    get_organisation_stats,
+    get_rollups,
+    get_store,
+    get_weekday_stats,
     jsonify,
-    mean,
+    jsonify_stream,
+    jsonify_stream_object,
+    response_cache,
+    watcher_running,
 )
 
 import logging
@@ -27,37 +56,254 @@ def mainpage():
     return redirect('/static/presence_weekday.html')
 
 
+@app.endpoint('static')
+def static_view(filename):
+    """
+    Serves static file compressed with the best encoding client accepts.
+
+    Files are compressed once, fingerprinted names of them, which pages
+    refer to, are cached by clients for STATIC_MAX_AGE seconds.
+    """
+    if not app.config['STATIC_PRECOMPRESS']:
+        return app.send_static_file(filename)
+    asset = static_assets().get(filename)
+    if asset is None:
+        log.debug('Static file %s not found!', filename)
+        abort(404)
+
+    encoding = accepted_encoding(
+        [encoding for encoding in ENCODINGS if encoding in asset.bodies]
+    )
+    etag = encoded_etag(asset.fingerprint, encoding)
+    if is_resource_modified(request.environ, etag=etag):
+        response = Response(asset.bodies[encoding], mimetype=asset.mimetype)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+    else:
+        response = Response(status=304)
+    response.set_etag(etag)
+    if asset.immutable:
+        response.headers['Cache-Control'] = (
+            'public, max-age={0}, immutable'.format(
+                app.config['STATIC_MAX_AGE']
+            )
+        )
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    if len(asset.bodies) > 1:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+@app.route('/api/v1/_status', methods=['GET'])
+def status_view():
+    """
+    Returns information about the last reload of presence data.
+    """
+    status = dict(current_cache().reload_stats, watching=watcher_running())
+    return Response(dumps(status), mimetype='application/json')
+
+
+@app.route('/api/v1/_metrics', methods=['GET'])
+def metrics_view():
+    """
+    Returns collected metrics in Prometheus text format.
+    """
+    gauges = dict(
+        ('response_cache_' + name, value)
+        for name, value in response_cache.stats().iteritems()
+    )
+    reload_stats = current_cache().reload_stats
+    if reload_stats:
+        gauges['data_version'] = reload_stats['version']
+        gauges['data_reloaded_at_seconds'] = reload_stats['reloaded_at']
+        gauges['data_reload_duration_seconds'] = reload_stats['duration']
+        if reload_stats['rows'] is not None:
+            gauges['data_rows'] = reload_stats['rows']
+    return Response(
+        metrics.render(gauges), mimetype='text/plain; version=0.0.4'
+    )
+
+
 @app.route('/api/v1/users', methods=['GET'])
-@jsonify
+@jsonify_stream
 def users_view():
     """
     Users listing for dropdown.
     """
-    data = get_data()
+    store = get_store()
+    for i in store.users():
+        yield {'user_id': i, 'name': 'User {0}'.format(str(i))}
+
+
+def mean_time_weekday(stats):
+    """
+    Returns mean presence time grouped by weekday from WeekdayStats.
+    """
+    return time_weekday(stats.mean_intervals())
+
+
+def time_weekday(values):
+    """
+    Returns (weekday, value) pairs of seven values.
+    """
     return [
-        {'user_id': i, 'name': 'User {0}'.format(str(i))}
-        for i in data.keys()
+        (calendar.day_abbr[weekday], value)
+        for weekday, value in enumerate(values)
     ]
 
 
+def presence_weekday(stats):
+    """
+    Returns total presence time grouped by weekday from WeekdayStats.
+    """
+    result = [
+        (calendar.day_abbr[weekday], total)
+        for weekday, total in enumerate(stats.total_intervals())
+    ]
+
+    result.insert(0, ('Weekday', 'Presence (s)'))
+    return result
+
+
+def presence_start_end(stats):
+    """
+    Returns mean start and end of presence from WeekdayStats.
+    """
+    return start_end_weekday(stats.mean_starts(), stats.mean_ends())
+
+
+def start_end_weekday(starts, ends):
+    """
+    Returns (weekday, start, end) tuples of seven starts and ends.
+    """
+    return [
+        (calendar.day_abbr[weekday], start, end)
+        for weekday, (start, end) in enumerate(zip(starts, ends))
+    ]
+
+
+def requested_percentile():
+    """
+    Returns percent of percentile given in `stat` parameter.
+
+    Returns None for `mean`, which is the default.
+    """
+    stat = request.args.get('stat', 'mean')
+    if stat == 'mean':
+        return None
+    if stat not in PERCENTILES:
+        log.debug('Invalid statistic: %s', stat)
+        abort(400)
+    return PERCENTILES[stat]
+
+
+def requested_user_ids():
+    """
+    Returns list of user ids given in `user_id` query parameter or None.
+
+    Ids may be comma separated or given in repeated parameters, repeated
+    ids are returned once in order of their first occurrence.
+    """
+    values = request.args.getlist('user_id')
+    if not values:
+        return None
+    try:
+        return list(OrderedDict.fromkeys(
+            int(user_id)
+            for value in values
+            for user_id in value.split(',') if user_id
+        ))
+    except ValueError:
+        log.debug('Invalid user ids: %s', values)
+        abort(400)
+
+
+def requested_date_range():
+    """
+    Returns (date_from, date_to) given in `from` and `to` query parameters.
+
+    Dates are in YYYY-MM-DD format, missing ones are None.
+    """
+    try:
+        return tuple(
+            datetime.strptime(request.args[name], '%Y-%m-%d').date()
+            if request.args.get(name) else None
+            for name in ('from', 'to')
+        )
+    except ValueError:
+        log.debug('Invalid date range: %s', request.args)
+        abort(400)
+
+
+def batch_result(function):
+    """
+    Returns function results for requested users or for all users.
+
+    Results are lazily computed (user id, result) pairs, unknown users get
+    None. Query parameters are checked before anything is computed.
+    """
+    entry = get_entry()
+    date_from, date_to = requested_date_range()
+    user_ids = requested_user_ids()
+    if user_ids is None:
+        user_ids = entry.value.users()
+
+    all_stats = (
+        (user_id, entry_weekday_stats(entry, user_id, date_from, date_to))
+        for user_id in user_ids
+    )
+    return (
+        (str(user_id), function(stats) if stats is not None else None)
+        for user_id, stats in all_stats
+    )
+
+
 @app.route('/api/v1/mean_time_weekday/<int:user_id>', methods=['GET'])
 @jsonify
 def mean_time_weekday_view(user_id):
     """
     Returns mean presence time of given user grouped by weekday.
+
+    With `stat` parameter median, p10 or p90 is returned instead of mean.
     """
-    data = get_data()
-    if user_id not in data:
+    percent = requested_percentile()
+    date_range = requested_date_range()
+    if percent is None:
+        stats = get_weekday_stats(user_id, *date_range)
+    else:
+        stats = get_histograms(user_id, *date_range)
+    if stats is None:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], mean(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
+    if percent is None:
+        return mean_time_weekday(stats)
+    return time_weekday(stats.percentiles('intervals', percent))
 
-    return result
+
+@app.route('/api/v1/mean_time_weekday/all', methods=['GET'])
+@jsonify
+def organisation_mean_time_weekday_view():
+    """
+    Returns presence time of all users together grouped by weekday.
+
+    Takes the same parameters as mean_time_weekday_view().
+    """
+    percent = requested_percentile()
+    stats, histograms = get_organisation_stats(*requested_date_range())
+    if percent is None:
+        return mean_time_weekday(stats)
+    return time_weekday(histograms.percentiles('intervals', percent))
+
+
+@app.route('/api/v1/mean_time_weekday', methods=['GET'])
+@jsonify_stream_object
+def mean_time_weekday_batch_view():
+    """
+    Returns mean presence time of many users grouped by weekday.
+    """
+    return batch_result(mean_time_weekday)
 
 
 @app.route('/api/v1/presence_weekday/<int:user_id>', methods=['GET'])
@@ -66,19 +312,21 @@ def presence_weekday_view(user_id):
     """
     Returns total presence time of given user grouped by weekday.
     """
-    data = get_data()
-    if user_id not in data:
+    stats = get_weekday_stats(user_id, *requested_date_range())
+    if stats is None:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_by_weekday(data[user_id])
-    result = [
-        (calendar.day_abbr[weekday], sum(intervals))
-        for weekday, intervals in enumerate(weekdays)
-    ]
+    return presence_weekday(stats)
 
-    result.insert(0, ('Weekday', 'Presence (s)'))
-    return result
+
+@app.route('/api/v1/presence_weekday', methods=['GET'])
+@jsonify_stream_object
+def presence_weekday_batch_view():
+    """
+    Returns total presence time of many users grouped by weekday.
+    """
+    return batch_result(presence_weekday)
 
 
 @app.route('/api/v1/presence_start_end/<int:user_id>', methods=['GET'])
@@ -86,21 +334,125 @@ def presence_weekday_view(user_id):
 def presence_start_end_view(user_id):
     """
     Returns interval from start to end work.
+
+    With `stat` parameter median, p10 or p90 is returned instead of mean.
     """
-    data = get_data()
-    if user_id not in data:
+    percent = requested_percentile()
+    date_range = requested_date_range()
+    if percent is None:
+        stats = get_weekday_stats(user_id, *date_range)
+    else:
+        stats = get_histograms(user_id, *date_range)
+    if stats is None:
         log.debug('User %s not found!', user_id)
         abort(404)
 
-    weekdays = group_start_end_weekday(data[user_id])
+    if percent is None:
+        return presence_start_end(stats)
+    return start_end_weekday(
+        stats.percentiles('starts', percent),
+        stats.percentiles('ends', percent),
+    )
 
-    for day in weekdays:
-        day['start'] = mean(day['start'])
-        day['end'] = mean(day['end'])
 
-    result = [
-        (calendar.day_abbr[weekday], value['start'], value['end'])
-        for weekday, value in enumerate(weekdays)
-    ]
+@app.route('/api/v1/presence_start_end/all', methods=['GET'])
+@jsonify
+def organisation_presence_start_end_view():
+    """
+    Returns interval from start to end work of all users together.
+
+    Takes the same parameters as presence_start_end_view().
+    """
+    percent = requested_percentile()
+    stats, histograms = get_organisation_stats(*requested_date_range())
+    if percent is None:
+        return presence_start_end(stats)
+    return start_end_weekday(
+        histograms.percentiles('starts', percent),
+        histograms.percentiles('ends', percent),
+    )
+
+
+@app.route('/api/v1/presence_start_end', methods=['GET'])
+@jsonify_stream_object
+def presence_start_end_batch_view():
+    """
+    Returns interval from start to end work of many users.
+    """
+    return batch_result(presence_start_end)
+
+
+@app.route('/api/v1/occupancy', methods=['GET'])
+@jsonify
+def occupancy_view():
+    """
+    Returns number of users present in every slot of a day.
+
+    Slot length in minutes is given in `slot` parameter, 15 by default.
+    With `by=weekday` mean numbers for every weekday are returned instead
+    of numbers for every date. Dates can be limited with `from` and `to`.
+    """
+    try:
+        slot = int(request.args.get('slot', 15))
+    except ValueError:
+        slot = 0
+    if not 0 < slot <= 24 * 60 or SECONDS_PER_DAY % (slot * 60):
+        log.debug('Invalid slot: %s', request.args.get('slot'))
+        abort(400)
+    grouping = request.args.get('by', 'date')
+    if grouping not in ('date', 'weekday'):
+        log.debug('Invalid grouping: %s', grouping)
+        abort(400)
+
+    counts = occupancy(
+        get_store().intervals(*day_range(*requested_date_range())),
+        slot * 60,
+    )
+    if grouping == 'weekday':
+        counts = dict(
+            (calendar.day_abbr[weekday], weekday_counts)
+            for weekday, weekday_counts in weekday_occupancy(counts).items()
+        )
+    else:
+        counts = dict(
+            (date.fromordinal(day).isoformat(), day_counts)
+            for day, day_counts in counts.items()
+        )
+    return {
+        'slots': [
+            '{0:02d}:{1:02d}'.format(minute // 60, minute % 60)
+            for minute in xrange(0, 24 * 60, slot)
+        ],
+        'occupancy': counts,
+    }
+
+
+@app.route('/api/v1/rollup/<period>', methods=['GET'])
+@jsonify
+def organisation_rollup_view(period):
+    """
+    Returns total and mean presence time of all users per week or month.
+    """
+    if period not in PERIODS:
+        log.debug('Period %s not found!', period)
+        abort(404)
+
+    return get_rollups().report(period)
+
+
+@app.route('/api/v1/rollup/<period>/<int:user_id>', methods=['GET'])
+@jsonify
+def rollup_view(period, user_id):
+    """
+    Returns total and mean presence time of given user per week or month.
+    """
+    if period not in PERIODS:
+        log.debug('Period %s not found!', period)
+        abort(404)
+
+    result = get_rollups().report(period, user_id)
+    if result is None:
+        log.debug('User %s not found!', user_id)
+        abort(404)
 
     return result